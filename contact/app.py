@@ -0,0 +1,12 @@
+from django.conf import settings
+from rapidsms.apps.base import AppBase
+from contact.matching import apply_flags
+
+
+class App(AppBase):
+
+    def filter(self, message):
+        # flag every incoming message as it arrives; never stops processing
+        if getattr(settings, 'CONTACT_AUTO_FLAG', True) and hasattr(message, 'db_message'):
+            apply_flags(message.db_message)
+        return False
@@ -0,0 +1,223 @@
+from django.db import connection, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
+from rapidsms.models import Contact
+from contact.models import MessageFlag, FlaggedMessage
+
+
+def _pk_subquery(queryset):
+    """
+    Returns the SQL and params selecting the distinct pks of
+    ``queryset``, wrapped in a derived table so mysql accepts it next to
+    the table being changed, or None when the queryset can't match
+    anything.
+    """
+    try:
+        sql, params = queryset.order_by().values('pk').query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+    pk = connection.ops.quote_name(queryset.model._meta.pk.column)
+    return "SELECT DISTINCT selected.%s FROM (%s) selected" % (pk, sql), list(params)
+
+
+def _membership_sql(contacts):
+    """
+    Returns the names the statements below need and the SQL of the pks of
+    ``contacts``, or None when the queryset can't match anything.
+    """
+    qn = connection.ops.quote_name
+    field = Contact._meta.get_field('groups')
+    subquery = _pk_subquery(contacts)
+    if subquery is None:
+        return None
+    names = {
+        'through': qn(field.m2m_db_table()),
+        'contact_id': qn(field.m2m_column_name()),
+        'group_id': qn(field.m2m_reverse_name()),
+        'groups': qn(field.rel.to._meta.db_table),
+        'contacts': subquery[0],
+    }
+    return names, subquery[1]
+
+
+@transaction.commit_on_success
+def add_to_groups(contacts, groups):
+    """
+    Adds every contact in the ``contacts`` queryset to each of ``groups``
+    (Groups or pks) with one INSERT ... SELECT that skips the memberships
+    that already exist.  Returns the number of memberships added.  No
+    m2m_changed signals are sent.
+    """
+    group_ids = [getattr(g, 'pk', g) for g in groups]
+    prepared = _membership_sql(contacts)
+    if not group_ids or prepared is None:
+        return 0
+    names, params = prepared
+    names['group_list'] = ", ".join(["%s"] * len(group_ids))
+    cursor = connection.cursor()
+    cursor.execute("""
+        INSERT INTO %(through)s (%(contact_id)s, %(group_id)s)
+        SELECT c.id, g.id FROM (%(contacts)s) c, %(groups)s g
+         WHERE g.id IN (%(group_list)s)
+           AND NOT EXISTS (SELECT 1 FROM %(through)s t
+                            WHERE t.%(contact_id)s = c.id AND t.%(group_id)s = g.id)""" % names,
+                   params + group_ids)
+    transaction.set_dirty()
+    return cursor.rowcount
+
+
+@transaction.commit_on_success
+def remove_from_groups(contacts, groups):
+    """
+    Removes every contact in the ``contacts`` queryset from each of
+    ``groups`` with one DELETE.  Returns the number of memberships removed.
+    No m2m_changed signals are sent.
+    """
+    group_ids = [getattr(g, 'pk', g) for g in groups]
+    prepared = _membership_sql(contacts)
+    if not group_ids or prepared is None:
+        return 0
+    names, params = prepared
+    names['group_list'] = ", ".join(["%s"] * len(group_ids))
+    cursor = connection.cursor()
+    cursor.execute("""
+        DELETE FROM %(through)s
+         WHERE %(group_id)s IN (%(group_list)s)
+           AND %(contact_id)s IN (%(contacts)s)""" % names,
+                   group_ids + params)
+    transaction.set_dirty()
+    return cursor.rowcount
+
+
+def _flag_condition(flag):
+    if flag is None:
+        return "flag_id IS NULL", []
+    return "flag_id = %s", [getattr(flag, 'pk', flag)]
+
+
+# a per-connection scratch table holding the messages a flag change touches
+SELECTED_MESSAGES = 'contact_selected_messages'
+
+
+def _snapshot(cursor, sql, params):
+    """
+    Copies the message pks ``sql`` selects into SELECTED_MESSAGES with one
+    INSERT ... SELECT, so the statements that follow act on, and recount,
+    the same messages even when the change moves them out of a selection
+    filtered on flags.  Returns the number of messages copied.
+    """
+    cursor.execute("DROP TABLE IF EXISTS %s" % SELECTED_MESSAGES)
+    cursor.execute("CREATE TEMPORARY TABLE %s (id integer PRIMARY KEY)" % SELECTED_MESSAGES)
+    cursor.execute("INSERT INTO %s (id) %s" % (SELECTED_MESSAGES, sql), params)
+    return cursor.rowcount
+
+
+def _recount(cursor, where, params):
+    names = {
+        'summary': connection.ops.quote_name(FlaggedMessage._meta.db_table),
+        'flags': connection.ops.quote_name(MessageFlag._meta.db_table),
+        'where': where,
+    }
+    cursor.execute("DELETE FROM %(summary)s %(where)s" % names, params)
+    cursor.execute("""
+        INSERT INTO %(summary)s (message_id, flag_count)
+        SELECT message_id, COUNT(*) FROM %(flags)s
+         %(where)s
+         GROUP BY message_id""" % names, params)
+    return cursor.rowcount
+
+
+@transaction.commit_on_success
+def flag_messages(messages, flag=None):
+    """
+    Flags every message in the ``messages`` queryset with ``flag`` (a Flag,
+    its pk, or None for a plain flag), skipping the messages already
+    carrying it, and adds one to their FlaggedMessage counts.  The number
+    of statements doesn't depend on the size of the selection.  Returns
+    the number of messages flagged.
+    """
+    subquery = _pk_subquery(messages)
+    if subquery is None:
+        return 0
+    sql, params = subquery
+    condition, condition_params = _flag_condition(flag)
+    names = {
+        'flags': connection.ops.quote_name(MessageFlag._meta.db_table),
+        'summary': connection.ops.quote_name(FlaggedMessage._meta.db_table),
+        'selected': SELECTED_MESSAGES,
+        'messages': sql,
+        'condition': condition,
+    }
+    cursor = connection.cursor()
+    flagged = _snapshot(cursor, """
+        SELECT m.id FROM (%(messages)s) m
+         WHERE NOT EXISTS (SELECT 1 FROM %(flags)s f WHERE f.message_id = m.id AND f.%(condition)s)""" % names,
+        params + condition_params)
+    if flagged:
+        cursor.execute("INSERT INTO %(flags)s (message_id, flag_id) SELECT id, %%s FROM %(selected)s" % names,
+                       [getattr(flag, 'pk', flag)])
+        cursor.execute("UPDATE %(summary)s SET flag_count = flag_count + 1 "
+                       "WHERE message_id IN (SELECT id FROM %(selected)s)" % names)
+        cursor.execute("""
+            INSERT INTO %(summary)s (message_id, flag_count)
+            SELECT s.id, 1 FROM %(selected)s s
+             WHERE NOT EXISTS (SELECT 1 FROM %(summary)s t WHERE t.message_id = s.id)""" % names)
+    cursor.execute("DROP TABLE %s" % SELECTED_MESSAGES)
+    transaction.set_dirty()
+    return flagged
+
+
+@transaction.commit_on_success
+def unflag_messages(messages, flag=None, all_flags=False):
+    """
+    Removes ``flag`` (or, with ``all_flags``, every flag) from the messages
+    in the ``messages`` queryset and recounts the flags of the messages it
+    touched, in a fixed number of statements.  Returns the number of
+    MessageFlag rows removed.
+    """
+    subquery = _pk_subquery(messages)
+    if subquery is None:
+        return 0
+    sql, params = subquery
+    condition, condition_params = ("1 = 1", []) if all_flags else _flag_condition(flag)
+    names = {
+        'flags': connection.ops.quote_name(MessageFlag._meta.db_table),
+        'selected': SELECTED_MESSAGES,
+        'messages': sql,
+        'condition': condition,
+    }
+    cursor = connection.cursor()
+    removed = 0
+    if _snapshot(cursor, "SELECT DISTINCT message_id FROM %(flags)s WHERE message_id IN (%(messages)s) "
+                         "AND %(condition)s" % names, params + condition_params):
+        cursor.execute("DELETE FROM %(flags)s WHERE message_id IN (SELECT id FROM %(selected)s) "
+                       "AND %(condition)s" % names, condition_params)
+        removed = cursor.rowcount
+        _recount(cursor, "WHERE message_id IN (SELECT id FROM %s)" % SELECTED_MESSAGES, [])
+    cursor.execute("DROP TABLE %s" % SELECTED_MESSAGES)
+    transaction.set_dirty()
+    return removed
+
+
+# message pks recounted per statement by refresh_flagged_messages
+REFRESH_CHUNK_SIZE = 1000
+
+
+@transaction.commit_on_success
+def refresh_flagged_messages(message_ids=None):
+    """
+    Recomputes the FlaggedMessage rows of the messages whose pks are in
+    ``message_ids`` (every message when None) from MessageFlag, with a
+    DELETE and an INSERT ... SELECT per chunk of pks.  Returns the number
+    of flagged messages written.
+    """
+    cursor = connection.cursor()
+    written = 0
+    if message_ids is None:
+        written = _recount(cursor, "", [])
+    else:
+        message_ids = list(message_ids)
+        for start in range(0, len(message_ids), REFRESH_CHUNK_SIZE):
+            chunk = message_ids[start:start + REFRESH_CHUNK_SIZE]
+            written += _recount(cursor, "WHERE message_id IN (%s)" % ", ".join(["%s"] * len(chunk)), chunk)
+    transaction.set_dirty()
+    return written
@@ -0,0 +1,33 @@
+import uuid
+from django.core.cache import cache
+
+# generations are kept for 30 days, the longest relative timeout memcached
+# accepts; an expired generation is simply replaced by a new one, which at
+# worst costs every process one rebuild of whatever it had cached locally.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def get_generation(key):
+    """
+    Returns the current generation token stored under ``key`` in the shared
+    cache, creating one if none exists yet.  Processes keep their own copies
+    of expensive derived data next to the generation they were built for,
+    and rebuild as soon as the shared token moves on.
+    """
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _new_generation(), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(key):
+    """
+    Invalidates everything built for the current generation of ``key``, in
+    this process and in every other process sharing the cache backend.
+    """
+    cache.set(key, _new_generation(), GENERATION_TIMEOUT)
@@ -0,0 +1,76 @@
+import csv
+from django.utils import simplejson
+from contact.models import MessageFlag
+
+EXPORT_CHUNK_SIZE = 2000
+
+MESSAGE_FIELDS = ('id', 'date', 'identity', 'text', 'application')
+DETAIL_FIELDS = ('contact', 'district', 'flags')
+
+
+def message_rows(messages, details=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields one dict per message in ``messages``, newest first, reading the
+    queryset a chunk at a time by seeking on pk, so memory stays flat
+    however many messages there are.  With ``details``, contact name and
+    district are joined in and flag names cost one more query per chunk.
+    """
+    columns = ['pk', 'date', 'connection__identity', 'text', 'application']
+    if details:
+        columns += ['connection__contact__name', 'connection__contact__district__name']
+    messages = messages.order_by('-pk')
+    last_pk = None
+    while True:
+        chunk = messages if last_pk is None else messages.filter(pk__lt=last_pk)
+        chunk = list(chunk.values_list(*columns)[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        if details:
+            flag_map = MessageFlag.get_flag_map([row[0] for row in chunk])
+        for row in chunk:
+            message = dict(zip(MESSAGE_FIELDS, row[:5]))
+            if details:
+                message['contact'] = row[5] or ''
+                message['district'] = row[6] or ''
+                message['flags'] = [name or 'flagged' for name in flag_map.get(row[0], [])]
+            yield message
+
+
+class _Line(object):
+    """ a file-like object that hands back what the csv writer wrote to it """
+
+    def write(self, value):
+        self.value = value
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def csv_lines(rows, details=False):
+    fields = MESSAGE_FIELDS + (DETAIL_FIELDS if details else ())
+    line = _Line()
+    writer = csv.writer(line)
+    writer.writerow(fields)
+    yield line.value
+    for row in rows:
+        if details:
+            row['flags'] = ", ".join(row['flags'])
+        row['date'] = row['date'].strftime('%Y-%m-%d %H:%M:%S') if row['date'] else ''
+        writer.writerow([_encode(row[f]) for f in fields])
+        yield line.value
+
+
+def ndjson_lines(rows, details=False):
+    for row in rows:
+        row['date'] = row['date'].isoformat() if row['date'] else None
+        yield simplejson.dumps(row) + "\n"
+
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv', 'csv'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson', 'ndjson'),
+}
@@ -16,3 +16,37 @@ class DemographicContact(models.Model):
 
     class Meta:
         abstract = True
+
+
+class DistrictContact(models.Model):
+    """
+    This extension keeps the district a Contact's reporting_location lies
+    in alongside it, so messages and contacts can be filtered by district
+    with a single indexed comparison.  contact.models keeps it in sync.
+    """
+    district = models.ForeignKey('locations.Location', blank=True, null=True, editable=False,
+                                 related_name='district_contacts')
+
+    class Meta:
+        abstract = True
+
+
+class MassTextContact(models.Model):
+    """
+    This extension gives Contacts an accessor for the mass texts sent to
+    them.  Newer mass texts keep their recipients in a compact set rather
+    than in the many-to-many table, whose own accessor is accordingly
+    named ``contact.legacy_masstexts``; ``contact.masstexts`` (or
+    get_masstexts()) answers for both kinds.  Queryset lookups across the
+    relation, such as Contact.objects.filter(masstexts=...), only see the
+    older texts and must be spelled ``legacy_masstexts``.
+    """
+
+    def get_masstexts(self):
+        from contact.models import MassText
+        return MassText.objects.sent_to(self)
+
+    masstexts = property(get_masstexts)
+
+    class Meta:
+        abstract = True
@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 import logging
 from django import forms
-from rapidsms.models import Contact, Connection
+from rapidsms.models import Contact, Connection, Backend
 from django.contrib.auth.models import Group
 from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
 from rapidsms_httprouter.models import Message
-from rapidsms.messages.outgoing import OutgoingMessage
 from generic.forms import ActionForm, FilterForm
-from contact.models import MassText, Flag
+from contact.models import MassText, Flag, record_sent
+from contact.sending import async_mass_text, queue_mass_text, send_mass_text, send_replies
+from contact.outbound import outbound_scheduler, queue_replies
+from contact.bulk import add_to_groups, remove_from_groups, flag_messages, unflag_messages
+from contact.search import get_search_backend, search_contacts
+from contact.cache import get_generation, bump_generation
 from django.contrib.sites.models import Site
 from rapidsms.contrib.locations.models import Location
 from django.conf import settings
@@ -18,6 +24,41 @@ from django.utils.safestring import mark_safe
 
 logger = logging.getLogger(__name__)
 
+# shared cache key that moves on whenever a Location or Group changes, so the
+# choices below are rebuilt by every process on next use
+FILTER_CHOICES_GENERATION = 'contact-filter-choices-generation'
+_filter_choices = {}
+
+
+def cached_choices(name, build):
+    """
+    Returns the choices ``build()`` computes, built on first use and kept
+    by this process until a Location or Group is saved or deleted.
+    """
+    generation = get_generation(FILTER_CHOICES_GENERATION)
+    cached = _filter_choices.get(name)
+    if cached is None or generation is None or cached[0] != generation:
+        cached = (generation, build())
+        _filter_choices[name] = cached
+    return cached[1]
+
+
+def district_choices():
+    return cached_choices('districts', lambda: tuple([(int(d.pk), d.name) for d in Location.objects.filter(
+        type__slug='district').order_by('name')]))
+
+
+def group_choices():
+    return cached_choices('groups', lambda: tuple([(int(g.pk), g.name) for g in Group.objects.all().order_by('name')]))
+
+
+def filter_choices_changed(sender, **kwargs):
+    bump_generation(FILTER_CHOICES_GENERATION)
+
+for model in (Location, Group):
+    post_save.connect(filter_choices_changed, sender=model)
+    post_delete.connect(filter_choices_changed, sender=model)
+
 
 
 class SMSInput(forms.Textarea):
@@ -149,7 +190,7 @@ class FilterGroupsForm(FilterForm):
         else:
             forms.Form.__init__(self, **kwargs)
         if hasattr(Contact, 'groups'):
-            choices = ((-1, 'No Group'),) + tuple([(int(g.pk), g.name) for g in Group.objects.all().order_by('name')])
+            choices = ((-1, 'No Group'),) + group_choices()
             self.fields['groups'] = forms.MultipleChoiceField(choices=choices, required=True)
 
     def filter(self, request, queryset):
@@ -190,28 +231,27 @@ class NewContactForm(forms.ModelForm):
         model = Contact
 
 
+class ContactImportForm(forms.Form):
+    """ upload form for a csv or xlsx contact list, see contact.importer """
+
+    file = forms.FileField(help_text="csv or xlsx; the first row names the columns: phone, and optionally "
+                                     "name, backend and location")
+    backend = forms.ModelChoiceField(queryset=Backend.objects.order_by('name'), required=False,
+                                     help_text="for rows without a backend column")
+    dry_run = forms.BooleanField(required=False, label="Only check the file")
+
+
 class FreeSearchForm(FilterForm):
-    """ concrete implementation of filter form
-        TO DO: add ability to search for multiple search terms separated by 'or'
-    """
+    """ concrete implementation of filter form """
 
     searchx = forms.CharField(max_length=100, required=False, label="Free-form search",
-                              help_text="Use 'or' to search for multiple names")
+                              help_text="Names, places or the last digits of a number; use 'or' to search for several")
 
     def filter(self, request, queryset):
         searchx = self.cleaned_data['searchx'].strip()
         if searchx == "":
             return queryset
-        elif searchx[0] in ["'", '"'] and searchx[-1] in ["'", '"']:
-            searchx = searchx[1:-1]
-            return queryset.filter(Q(name__iregex=".*\m(%s)\y.*" % searchx)
-                                   | Q(reporting_location__name__iregex=".*\m(%s)\y.*" % searchx)
-                                   | Q(connection__identity__iregex=".*\m(%s)\y.*" % searchx))
-
-        else:
-            return queryset.filter(Q(name__icontains=searchx)
-                                   | Q(reporting_location__name__icontains=searchx)
-                                   | Q(connection__identity__icontains=searchx))
+        return search_contacts(queryset, searchx)
 
 
 class FreeSearchForm2(FilterForm):
@@ -242,12 +282,12 @@ class FreeSearchTextForm(FilterForm):
     """ concrete implementation of filter form """
 
     search = forms.CharField(max_length=100, required=True, label="Free-form search",
-                             #help_text="Use 'or' to search for multiple names",
+                             help_text='Use "quotes" for phrases and \'or\' for alternatives',
                              widget=forms.TextInput(attrs={'class': 'itext', 'size': 14}))
 
     def filter(self, request, queryset):
         search = self.cleaned_data['search']
-        return queryset.filter(text__icontains=search)
+        return get_search_backend().filter(queryset, search)
 
 
 class HandledByForm(FilterForm):
@@ -268,16 +308,12 @@ class HandledByForm(FilterForm):
 class DistictFilterForm(FilterForm):
     """ filter cvs districs on their districts """
 
-    district2 = forms.ChoiceField(label="District", choices=(('', '-----'), (-1,
-                                                                             'No District')) + tuple([(int(d.pk),
-                                                                                                       d.name) for d in
-                                                                                                      Location.objects.filter(
-                                                                                                          type__slug='district'
-                                                                                                      ).order_by(
-                                                                                                          'name')]),
-                                  required=False,
+    district2 = forms.ChoiceField(label="District", choices=(), required=False,
                                   widget=forms.Select({'onchange': 'update_district2(this)'}))
 
+    def __init__(self, *args, **kwargs):
+        super(DistictFilterForm, self).__init__(*args, **kwargs)
+        self.fields['district2'].choices = (('', '-----'), (-1, 'No District')) + district_choices()
 
     def filter(self, request, queryset):
         district_pk = self.cleaned_data['district2']
@@ -299,8 +335,11 @@ class DistictFilterForm(FilterForm):
 
 
 class RolesFilter(FilterForm):
-    role = forms.ChoiceField(choices=(('', '----'),) + tuple(
-        [(int(g.id), g.name) for g in Group.objects.all().order_by('name')]), required=False)
+    role = forms.ChoiceField(choices=(), required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(RolesFilter, self).__init__(*args, **kwargs)
+        self.fields['role'].choices = (('', '----'),) + group_choices()
 
     def filter(self, request, queryset):
         group_pk = self.cleaned_data['role']
@@ -336,13 +375,11 @@ class MultipleDistictFilterForm(FilterForm):
 
 class DistictFilterMessageForm(FilterForm):
     """ filter cvs districs on their districts """
-    district = forms.ChoiceField(choices=(('', '-----'), (-1,
-                                                          'No District')) + tuple([(int(d.pk),
-                                                                                    d.name) for d in
-                                                                                   Location.objects.filter(
-                                                                                       type__slug='district'
-                                                                                   ).order_by('name')]), required=False)
+    district = forms.ChoiceField(choices=(), required=False)
 
+    def __init__(self, *args, **kwargs):
+        super(DistictFilterMessageForm, self).__init__(*args, **kwargs)
+        self.fields['district'].choices = (('', '-----'), (-1, 'No District')) + district_choices()
 
     def filter(self, request, queryset):
         district_pk = self.cleaned_data['district']
@@ -351,15 +388,7 @@ class DistictFilterMessageForm(FilterForm):
         elif int(district_pk) == -1:
             return queryset.filter(Q(connection__contact=None) | Q(connection__contact__reporting_location=None))
         else:
-            try:
-                district = Location.objects.get(pk=district_pk)
-            except Location.DoesNotExist:
-                district = None
-            if district:
-                return queryset.filter(
-                    connection__contact__reporting_location__in=district.get_descendants(include_self=True))
-            else:
-                return queryset
+            return queryset.filter(connection__contact__district=district_pk)
 
 
 class MassTextForm(ActionForm):
@@ -387,38 +416,40 @@ class MassTextForm(ActionForm):
         return text
 
     def perform(self, request, results):
-        if type(results).__name__ != 'QuerySet':
+        if not isinstance(results, QuerySet):
             results = Contact.objects.filter(pk__in=request.REQUEST.get('results', ""))
-        if results is None or len(results) == 0:
+        if results is None or not results.exists():
             return 'A message must have one or more recipients!', 'error'
 
         if request.user and request.user.has_perm('contact.can_message'):
-            if type(results[0]).__name__ == 'Reporters':
+            text = self.cleaned_data.get('text', "")
+            text = text.replace('%', u'\u0025')
+            if results.model.__name__ == 'Reporters':
 
                 con_ids = \
                     [r.default_connection.split(',')[1] if len(r.default_connection.split(',')) > 1 else 0 for r in
                      results]
                 connections = list(Connection.objects.filter(pk__in=con_ids).distinct())
                 contacts = list(Contact.objects.filter(pk__in=results.values_list('id', flat=True)))
-                print contacts
-            else:
-                connections = \
-                    list(Connection.objects.filter(contact__pk__in=results.values_list('id', flat=True)).distinct())
-                contacts = list(results)
-            text = self.cleaned_data.get('text', "")
-            text = text.replace('%', u'\u0025')
-            messages = Message.mass_text(text, connections)
-
-            MassText.bulk.bulk_insert(send_pre_save=False,
-                                      user=request.user,
-                                      text=text,
-                                      contacts=contacts)
-            masstexts = MassText.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
-            masstext = masstexts[0]
-            if settings.SITE_ID:
-                masstext.sites.add(Site.objects.get_current())
-
-            return 'Message successfully sent to %d numbers' % len(connections), 'success',
+                messages = Message.mass_text(text, connections)
+                record_sent([c.pk for c in connections])
+
+                MassText.bulk.bulk_insert(send_pre_save=False,
+                                          user=request.user,
+                                          text=text,
+                                          contacts=contacts)
+                masstexts = MassText.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+                masstext = masstexts[0]
+                if settings.SITE_ID:
+                    masstext.sites.add(Site.objects.get_current())
+                return 'Message successfully sent to %d numbers' % len(connections), 'success',
+
+            if async_mass_text():
+                masstext = queue_mass_text(request.user, text, results)
+                return mark_safe('Message queued for %d numbers, <a href="/contact/massmessages/">follow its progress</a>'
+                                 % masstext.recipient_count), 'success',
+            masstext = send_mass_text(request.user, text, results)
+            return 'Message successfully sent to %d numbers' % masstext.recipient_count, 'success',
         else:
             return "You don't have permission to send messages!", 'error',
 
@@ -428,16 +459,14 @@ class ReplyTextForm(ActionForm):
     action_label = 'Reply to selected'
 
     def perform(self, request, results):
-        if results is None or len(results) == 0:
+        if results is None or not results.exists():
             return ('A message must have one or more recipients!', 'error')
 
         if request.user and request.user.has_perm('contact.can_message'):
-            router = get_router()
             text = self.cleaned_data['text']
-            for msg in results:
-                outgoing = OutgoingMessage(msg.connection, text)
-                router.handle_outgoing(outgoing, msg)
-            return ('%d messages sent successfully' % results.count(), 'success',)
+            if outbound_scheduler():
+                return ('%d messages queued for sending' % queue_replies(text, results), 'success',)
+            return ('%d messages sent successfully' % send_replies(text, results), 'success',)
         else:
             return ("You don't have permission to send messages!", 'error',)
 
@@ -467,10 +496,8 @@ class AssignGroupForm(ActionForm):
     def perform(self, request, results):
         groups = self.cleaned_data['groups']
         contacts = Contact.objects.filter(pk__in=results)
-        for c in contacts:
-            for g in groups:
-                c.groups.add(g)
-        return ('%d Contacts assigned to %d groups.' % (len(results), len(groups)), 'success',)
+        added = add_to_groups(contacts, groups)
+        return ('%d Contacts assigned to %d groups, %d memberships added.' % (contacts.count(), len(groups), added), 'success',)
 
 
 class RemoveGroupForm(ActionForm):
@@ -493,10 +520,8 @@ class RemoveGroupForm(ActionForm):
     def perform(self, request, results):
         groups = self.cleaned_data['groups']
         contacts = Contact.objects.filter(pk__in=results)
-        for c in contacts:
-            for g in groups:
-                c.groups.remove(g)
-        return ('%d Contacts removed from %d groups.' % (len(results), len(groups)), 'success',)
+        removed = remove_from_groups(contacts, groups)
+        return ('%d Contacts removed from %d groups, %d memberships removed.' % (contacts.count(), len(groups), removed), 'success',)
 
 
 class FlaggedForm(FilterForm):
@@ -509,28 +534,30 @@ class FlaggedForm(FilterForm):
         if flagged == '':
             return queryset
         elif int(flagged) == 1:
-            return queryset.exclude(flags=None)
+            return queryset.filter(flag_summary__flag_count__gt=0)
         else:
-            return queryset.filter(flags=None)
+            return queryset.filter(flag_summary=None)
 
 
 class FlagMessageForm(ActionForm):
     """ flag/unflag messages action form """
 
     flag = forms.ChoiceField(choices=(('', '-----'), ('flag', 'Flag'), ('unflag', 'Unflag'),))
+    flag_type = forms.ModelChoiceField(queryset=Flag.objects.order_by('name'), required=False, label="Flag",
+                                       empty_label="(any)")
     action_label = 'Flag/Unflag selected'
 
     def perform(self, request, results):
-        if results is None or len(results) == 0:
+        if results is None or not results.exists():
             return ('You must select one or more messages to Flag or Unflag them!', 'error')
         flag = self.cleaned_data['flag']
-        for msg in results:
-            if flag == 'flag':
-                msg.flags.create()
-            else:
-                for msg_flag in msg.flags.all():
-                    msg_flag.delete()
-        return ('%d message(s) have been %sed' % (len(results), flag), 'successfully!',)
+        flag_type = self.cleaned_data.get('flag_type')
+        if flag == 'flag':
+            changed = flag_messages(results, flag_type)
+        else:
+            # without a flag chosen, unflagging clears every flag
+            changed = unflag_messages(results, flag_type, all_flags=flag_type is None)
+        return ('%d message(s) have been %sed' % (changed, flag), 'successfully!',)
 
 
 class GenderFilterForm(FilterForm):
@@ -0,0 +1,248 @@
+import csv
+import re
+from django.conf import settings
+from django.db import transaction
+from rapidsms.models import Contact, Connection, Backend
+from rapidsms.contrib.locations.models import Location
+from contact.models import get_district, index_contacts, index_connections
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# rows deduped and written per transaction
+IMPORT_BATCH_SIZE = getattr(settings, 'CONTACT_IMPORT_BATCH_SIZE', 1000)
+
+# the calling code a number written with a leading 0 is given, e.g. '256';
+# without one, numbers must be written in full international form
+COUNTRY_CODE = getattr(settings, 'CONTACT_IMPORT_COUNTRY_CODE', None)
+
+# rejected rows reported back, however many there are
+MAX_REPORTED_ERRORS = 100
+
+# the header names each column is recognized by, lowercased
+COLUMNS = (
+    ('phone', ('phone', 'phone number', 'identity', 'number')),
+    ('name', ('name',)),
+    ('backend', ('backend',)),
+    ('location', ('location', 'reporting location')),
+)
+
+BYTE_ORDER_MARK = u'\ufeff'
+
+PHONE_PUNCTUATION = re.compile(r"[\s\-\.\(\)/]")
+
+
+class ContactImportError(Exception):
+    """ raised for a file that can't be imported at all """
+    pass
+
+
+def normalize_phone(number, country_code=COUNTRY_CODE):
+    """
+    Returns ``number`` as the digits of its international form, the way
+    connection identities are stored ('256772123456'), or None when it
+    isn't a phone number.
+    """
+    number = PHONE_PUNCTUATION.sub("", number or "")
+    if number.startswith('+'):
+        number = number[1:]
+    elif number.startswith('00'):
+        number = number[2:]
+    elif number.startswith('0'):
+        if not country_code:
+            return None
+        number = country_code + number[1:]
+    if not number.isdigit() or not 8 <= len(number) <= 15:
+        return None
+    return number
+
+
+def _cell(value):
+    if value is None:
+        return u""
+    if isinstance(value, float) and value == int(value):
+        # spreadsheets keep phone numbers typed as numbers as floats
+        value = int(value)
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return unicode(value).strip()
+
+
+def csv_rows(f):
+    """ yields the rows of a utf-8 csv file as lists of unicode, a line at a time """
+    for row in csv.reader(f):
+        yield [_cell(value) for value in row]
+
+
+def xlsx_rows(f):
+    """ yields the rows of the first sheet of an xlsx workbook, without loading it whole """
+    if openpyxl is None:
+        raise ContactImportError("Importing xlsx files needs openpyxl to be installed")
+    try:
+        sheet = openpyxl.load_workbook(f, read_only=True).worksheets[0]
+    except Exception, e:
+        raise ContactImportError("The file can't be read as an xlsx workbook: %s" % e)
+    for row in sheet.iter_rows():
+        yield [_cell(cell.value) for cell in row]
+
+
+READERS = {'csv': csv_rows, 'xlsx': xlsx_rows}
+
+
+def read_rows(f, filename):
+    """ picks the reader for ``f`` from the extension of ``filename`` """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension not in READERS:
+        raise ContactImportError("Only %s files can be imported" % " and ".join(sorted(READERS)))
+    return READERS[extension](f)
+
+
+class ContactImporter(object):
+    """
+    Creates a Contact and a Connection for every row of a contact list,
+    reading the rows as a stream and writing them a batch at a time through
+    the Contact and Connection bulk managers, each batch in its own
+    transaction.
+
+    The first row names the columns: a phone column is required; name,
+    backend (a Backend name, defaulting to ``backend``) and location (the
+    name of the contact's reporting location) are optional.  Numbers that
+    already have a Connection, or that come up again further down the
+    file, are skipped; rows that can't be imported are counted and the
+    first MAX_REPORTED_ERRORS of them reported in ``errors`` as (line,
+    reason).  With ``dry_run`` the rows are checked but nothing is written.
+    """
+
+    def __init__(self, backend=None, country_code=COUNTRY_CODE, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+        self.default_backend = backend
+        self.country_code = country_code
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.rows = self.created = self.existing = self.repeated = self.invalid = 0
+        self.errors = []
+        self.seen = set()
+        self.backends = {}
+        self.locations = {}
+        self.districts = {}
+
+    def columns(self, header):
+        names = [name.lower() for name in header]
+        if names and names[0].startswith(BYTE_ORDER_MARK):
+            # excel starts "CSV UTF-8" files with a byte order mark
+            names[0] = names[0][len(BYTE_ORDER_MARK):].strip()
+        columns = {}
+        for field, aliases in COLUMNS:
+            for alias in aliases:
+                if alias in names:
+                    columns[field] = names.index(alias)
+                    break
+        if 'phone' not in columns:
+            raise ContactImportError("The first row must name the columns, including a phone column")
+        return columns
+
+    def reject(self, line, reason):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, reason))
+
+    def backend(self, name):
+        if name not in self.backends:
+            self.backends[name] = (list(Backend.objects.filter(name=name).values_list('pk', flat=True)) or [None])[0]
+        return self.backends[name]
+
+    def location(self, name):
+        key = name.lower()
+        if key not in self.locations:
+            locations = list(Location.objects.filter(name__iexact=name)[:2])
+            self.locations[key] = locations[0] if len(locations) == 1 else len(locations)
+        return self.locations[key]
+
+    def district_id(self, location):
+        if location is None:
+            return None
+        if location.pk not in self.districts:
+            district = get_district(location)
+            self.districts[location.pk] = district.pk if district else None
+        return self.districts[location.pk]
+
+    def parse(self, line, row, columns):
+        """ returns (identity, name, backend pk, location) for a row, or None when it is skipped """
+        def value(field):
+            index = columns.get(field)
+            return row[index] if index is not None and index < len(row) else u""
+
+        if not "".join(row):
+            return None
+        self.rows += 1
+        number = value('phone')
+        identity = normalize_phone(number, self.country_code)
+        if identity is None:
+            return self.reject(line, "'%s' is not a phone number" % number)
+        backend_name = value('backend') or self.default_backend
+        if not backend_name:
+            return self.reject(line, "no backend given")
+        backend_id = self.backend(backend_name)
+        if backend_id is None:
+            return self.reject(line, "there is no '%s' backend" % backend_name)
+        location = None
+        if value('location'):
+            location = self.location(value('location'))
+            if not isinstance(location, Location):
+                return self.reject(line, "%s location is named '%s'" % (
+                    "more than one" if location else "no", value('location')))
+        if identity in self.seen:
+            self.repeated += 1
+            return None
+        self.seen.add(identity)
+        return identity, value('name')[:100], backend_id, location
+
+    def run(self, rows):
+        """ imports ``rows``, lists of unicode cell values, the first of them naming the columns """
+        rows = iter(rows)
+        try:
+            columns = self.columns(rows.next())
+        except StopIteration:
+            raise ContactImportError("The file is empty")
+        batch = []
+        for line, row in enumerate(rows, 2):
+            parsed = self.parse(line, row, columns)
+            if parsed:
+                batch.append(parsed)
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+        return self
+
+    def write(self, batch):
+        existing = set(Connection.objects.filter(identity__in=[row[0] for row in batch])
+                       .values_list('identity', flat=True))
+        new = [row for row in batch if row[0] not in existing]
+        self.existing += len(batch) - len(new)
+        if new and not self.dry_run:
+            self.insert(new)
+        self.created += len(new)
+
+    @transaction.commit_on_success
+    def insert(self, rows):
+        for identity, name, backend_id, location in rows:
+            Contact.bulk.bulk_insert(send_pre_save=False,
+                                     name=name,
+                                     reporting_location_id=getattr(location, 'pk', None),
+                                     district_id=self.district_id(location))
+        contacts = Contact.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+        if len(contacts) != len(rows):
+            raise ContactImportError("%d contacts were written for %d rows" % (len(contacts), len(rows)))
+        for contact, (identity, name, backend_id, location) in zip(contacts, rows):
+            Connection.bulk.bulk_insert(send_pre_save=False,
+                                        identity=identity,
+                                        backend_id=backend_id,
+                                        contact_id=contact.pk)
+        connections = Connection.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+        # the bulk managers skip the save signals that index new contacts for search
+        index_contacts([(contact.pk, name, getattr(location, 'name', None))
+                        for contact, (identity, name, backend_id, location) in zip(contacts, rows)])
+        index_connections([(c.pk, c.contact_id, c.identity) for c in connections])
@@ -0,0 +1,153 @@
+import os
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import simplejson
+from rapidsms_httprouter.models import Message
+from contact.models import Flag, MessageFlag
+from contact.bulk import refresh_flagged_messages
+from contact.matching import get_matcher_class
+
+_matcher = None
+
+
+def _init_worker(matcher_class, flag_rules):
+    global _matcher
+    _matcher = matcher_class([Flag(pk=pk, rule=rule, words=words) for pk, rule, words in flag_rules])
+
+
+def _match_rows(rows):
+    pairs = []
+    for pk, text in rows:
+        for flag in _matcher.match(text):
+            pairs.append((pk, flag.pk))
+    return pairs
+
+
+@transaction.commit_on_success
+def _insert_pairs(first_pk, last_pk, pairs):
+    """
+    Inserts the (message, flag) pairs that don't exist yet for messages in
+    the (first_pk, last_pk] range and recounts the flags of the messages
+    they touch, returning how many rows were written.
+    """
+    if not pairs:
+        return 0
+    existing = set(MessageFlag.objects.filter(message__pk__gt=first_pk, message__pk__lte=last_pk)
+                   .exclude(flag=None).values_list('message', 'flag'))
+    pairs = [p for p in pairs if p not in existing]
+    if pairs:
+        opts = MessageFlag._meta
+        cursor = connection.cursor()
+        cursor.executemany("INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+            opts.db_table, opts.get_field('message').column, opts.get_field('flag').column), pairs)
+        transaction.set_dirty()
+        refresh_flagged_messages(set([message_pk for message_pk, flag_pk in pairs]))
+    return len(pairs)
+
+
+class Command(BaseCommand):
+    help = """Applies Flag rules to the existing incoming message history.  Messages are
+    read in primary-key order, matched in a pool of worker processes, and the
+    last fully written primary key is checkpointed so an interrupted run can
+    pick up where it left off."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--flag', action='append', dest='flags', type='int', default=[],
+                    help='pk of a Flag to apply; may be repeated (default: all flags with rules)'),
+        make_option('-c', '--chunk-size', dest='chunk_size', type='int', default=5000,
+                    help='number of messages read and matched per chunk'),
+        make_option('-p', '--processes', dest='processes', type='int', default=cpu_count(),
+                    help='number of matching processes, 1 matches in this process'),
+        make_option('--checkpoint', dest='checkpoint', default='backfill_flags.checkpoint',
+                    help='file recording the last message pk that was fully processed'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+                    help='ignore any existing checkpoint and start from the first message'),
+    )
+
+    def read_checkpoint(self, path, flag_pks):
+        if not os.path.exists(path):
+            return 0
+        state = simplejson.load(open(path))
+        if sorted(state['flags']) != flag_pks:
+            raise CommandError("%s was written for flags %s, use --restart to apply %s" % (
+                path, state['flags'], flag_pks))
+        return state['last_pk']
+
+    def write_checkpoint(self, path, flag_pks, last_pk):
+        tmp = "%s.tmp" % path
+        f = open(tmp, 'w')
+        simplejson.dump({'flags': flag_pks, 'last_pk': last_pk}, f)
+        f.close()
+        os.rename(tmp, path)
+
+    def chunks(self, last_pk, chunk_size):
+        messages = Message.objects.filter(direction='I').order_by('pk')
+        while True:
+            rows = list(messages.filter(pk__gt=last_pk).values_list('pk', 'text')[:chunk_size])
+            if not rows:
+                return
+            yield last_pk, rows[-1][0], rows
+            last_pk = rows[-1][0]
+
+    def handle(self, **options):
+        flags = Flag.objects.exclude(rule=None).exclude(words=None).order_by('pk')
+        if options['flags']:
+            flags = flags.filter(pk__in=options['flags'])
+        flag_rules = [(f.pk, f.rule, f.words) for f in flags]
+        if not flag_rules:
+            raise CommandError("There are no flags with rules to apply")
+        flag_pks = [pk for pk, rule, words in flag_rules]
+
+        checkpoint = options['checkpoint']
+        last_pk = 0 if options['restart'] else self.read_checkpoint(checkpoint, flag_pks)
+        processes = max(options['processes'], 1)
+
+        pool = None
+        if processes > 1:
+            # workers only match text, they must not share the parent's db connection
+            connection.close()
+            pool = Pool(processes, _init_worker, (get_matcher_class(), flag_rules))
+        else:
+            _init_worker(get_matcher_class(), flag_rules)
+
+        start = time.time()
+        processed = applied = 0
+        pending = deque()
+
+        def finish_oldest():
+            first_pk, chunk_last_pk, count, result = pending.popleft()
+            pairs = result.get() if pool else result
+            written = _insert_pairs(first_pk, chunk_last_pk, pairs)
+            self.write_checkpoint(checkpoint, flag_pks, chunk_last_pk)
+            elapsed = max(time.time() - start, 0.001)
+            self.stdout.write("up to message %d: %d messages, %d flags applied, %.1f messages/s\n" % (
+                chunk_last_pk, processed + count, applied + written, (processed + count) / elapsed))
+            return count, written
+
+        try:
+            for first_pk, chunk_last_pk, rows in self.chunks(last_pk, options['chunk_size']):
+                if pool:
+                    result = pool.apply_async(_match_rows, (rows,))
+                else:
+                    result = _match_rows(rows)
+                pending.append((first_pk, chunk_last_pk, len(rows), result))
+                # keep a bounded number of chunks in flight so memory stays flat
+                while len(pending) > processes * 2 or (not pool and pending):
+                    count, written = finish_oldest()
+                    processed += count
+                    applied += written
+            while pending:
+                count, written = finish_oldest()
+                processed += count
+                applied += written
+        finally:
+            if pool:
+                pool.terminate()
+
+        elapsed = max(time.time() - start, 0.001)
+        self.stdout.write("Done: %d messages, %d flags applied in %.1fs (%.1f messages/s)\n" % (
+            processed, applied, elapsed, processed / elapsed))
@@ -0,0 +1,94 @@
+import random
+import re
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from rapidsms_httprouter.models import Message
+from contact.models import Flag
+from contact.matching import FlagMatcher, TokenSetMatcher, FLAG_REGEX_FLAGS
+
+# vocabulary for the synthetic corpus, modelled on the short reports and
+# replies reporters send in: poll answers, place names, numbers, slang
+SMS_WORDS = ("yes no maybe please help thanks ok we our the a in at of is are not have has "
+             "water borehole broken clinic drugs malaria fever cholera outbreak measles "
+             "teacher school absent fees pupils road bridge flood rain drought hunger "
+             "police theft violence child abuse marriage sick dead died today tomorrow "
+             "week month village parish district kampala gulu lira mbale 2 3 10 25 100 "
+             "plz pls u r 4 gud bt nt wen hw dis dat ur mi").split()
+
+SYNTHETIC_FLAGS = [
+    (Flag.contains_one_of, "cholera, outbreak, measles"),
+    (Flag.contains_one_of, "abuse, violence, theft, child marriage"),
+    (Flag.contains_all_of, "borehole, broken"),
+    (Flag.contains_all_of, "teacher, absent, school"),
+    (Flag.contains_all_of, "drugs, clinic, no"),
+    (Flag.contains_one_of, "died, dead"),
+]
+
+
+class RegexFlagMatcher(object):
+    """ the baseline: every Flag's own rule_regex, searched one after the other """
+
+    def __init__(self, flags):
+        self.rules = [(flag, re.compile(flag.get_regex(), FLAG_REGEX_FLAGS))
+                      for flag in flags if flag.get_words() and flag.rule]
+
+    def match(self, text):
+        return [flag for flag, regex in self.rules if regex.search(text)]
+
+
+class Command(BaseCommand):
+    help = """Compares the per-flag rule_regex, combined pattern and token-set flag
+    evaluators on the same corpus, checking that they agree on every message."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--messages', dest='messages', type='int', default=20000,
+                    help='number of messages in the corpus'),
+        make_option('--synthetic', action='store_true', dest='synthetic', default=False,
+                    help='generate the corpus and flags instead of reading them from the database'),
+        make_option('--long', dest='long', type='float', default=0.05,
+                    help='share of synthetic messages that are long, multi-part texts'),
+        make_option('--seed', dest='seed', type='int', default=1),
+    )
+
+    def synthetic_corpus(self, count, long_share):
+        corpus = []
+        for i in range(count):
+            length = random.randint(60, 160) if random.random() > long_share else random.randint(600, 1600)
+            words = []
+            while sum([len(w) + 1 for w in words]) < length:
+                words.append(random.choice(SMS_WORDS))
+            corpus.append(u" ".join(words))
+        return corpus
+
+    def handle(self, **options):
+        random.seed(options['seed'])
+        if options['synthetic']:
+            flags = [Flag(pk=i + 1, name="flag %d" % (i + 1), rule=rule, words=words)
+                     for i, (rule, words) in enumerate(SYNTHETIC_FLAGS)]
+            corpus = self.synthetic_corpus(options['messages'], options['long'])
+        else:
+            flags = list(Flag.objects.exclude(rule=None).exclude(words=None))
+            corpus = list(Message.objects.filter(direction='I').order_by('-pk')
+                          .values_list('text', flat=True)[:options['messages']])
+        if not flags or not corpus:
+            raise CommandError("Nothing to benchmark, try --synthetic")
+
+        self.stdout.write("%d messages (%.0f characters on average), %d flags\n" % (
+            len(corpus), sum([len(t) for t in corpus]) / float(len(corpus)), len(flags)))
+
+        results = {}
+        for name, matcher_class in (('rule_regex', RegexFlagMatcher),
+                                    ('combined pattern', FlagMatcher),
+                                    ('token set', TokenSetMatcher)):
+            matcher = matcher_class(flags)
+            start = time.time()
+            results[name] = [sorted([f.pk for f in matcher.match(text)]) for text in corpus]
+            elapsed = max(time.time() - start, 0.000001)
+            self.stdout.write("%-18s %8.3fs %10.0f messages/s %8d flags applied\n" % (
+                name, elapsed, len(corpus) / elapsed, sum([len(r) for r in results[name]])))
+
+        for name in ('combined pattern', 'token set'):
+            mismatches = len([1 for a, b in zip(results['rule_regex'], results[name]) if a != b])
+            if mismatches:
+                self.stderr.write("%s disagrees with rule_regex on %d messages\n" % (name, mismatches))
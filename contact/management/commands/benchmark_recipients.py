@@ -0,0 +1,73 @@
+import resource
+import subprocess
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from rapidsms.models import Contact, Connection
+from contact.sending import connection_id_chunks, RECIPIENT_CHUNK_SIZE
+
+
+def materialized(contacts, chunk_size):
+    """ what MassTextForm.perform used to hold: every connection and contact as a model instance """
+    connections = list(Connection.objects.filter(contact__pk__in=contacts.values_list('id', flat=True)).distinct())
+    recipients = list(contacts)
+    return len(connections)
+
+
+def chunked(contacts, chunk_size):
+    count = 0
+    for contact_ids, connection_ids in connection_id_chunks(contacts, chunk_size):
+        count += len(connection_ids)
+    return count
+
+
+MODES = {'materialized': materialized, 'chunked': chunked}
+
+
+class Command(BaseCommand):
+    help = """Measures the peak RSS of resolving mass text recipients, the old
+    materialized way and chunk by chunk, for the first N contacts in the
+    database.  Each measurement runs in its own process, so peaks don't
+    carry over.  Nothing is sent."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='100,1000,10000,100000,1000000',
+                    help='comma separated recipient counts'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=RECIPIENT_CHUNK_SIZE),
+        make_option('--child', dest='child', default=None,
+                    help='internal: measure a single mode:size in this process'),
+    )
+
+    def contacts(self, size):
+        last = list(Contact.objects.order_by('pk').values_list('pk', flat=True)[size - 1:size])
+        if not last:
+            return None
+        return Contact.objects.filter(pk__lte=last[0])
+
+    def handle(self, **options):
+        if options['child']:
+            mode, size = options['child'].split(':')
+            contacts = self.contacts(int(size))
+            baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            count = MODES[mode](contacts, options['chunk_size'])
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.stdout.write("%d %d %d\n" % (count, baseline, peak))
+            return
+
+        total = Contact.objects.count()
+        sizes = [int(s) for s in options['sizes'].split(',') if int(s) <= total]
+        if not sizes:
+            raise CommandError("There are only %d contacts, pick smaller --sizes" % total)
+        self.stdout.write("%10s %12s %14s %14s\n" % ('contacts', 'connections', 'materialized', 'chunked'))
+        for size in sizes:
+            row = []
+            for mode in ('materialized', 'chunked'):
+                output = subprocess.Popen([sys.executable, sys.argv[0], 'benchmark_recipients',
+                                           '--child', '%s:%d' % (mode, size),
+                                           '--chunk-size', str(options['chunk_size'])],
+                                          stdout=subprocess.PIPE).communicate()[0]
+                count, baseline, peak = [int(v) for v in output.split()[-3:]]
+                row.append((count, peak - baseline))
+            # ru_maxrss is in kilobytes on linux
+            self.stdout.write("%10d %12d %11.1f MB %11.1f MB\n" % (
+                size, row[0][0], row[0][1] / 1024.0, row[1][1] / 1024.0))
@@ -0,0 +1,54 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from contact.models import MessageFlag, FlaggedMessage
+from contact.bulk import refresh_flagged_messages
+
+
+class Command(BaseCommand):
+    help = """Compares the FlaggedMessage rows with the MessageFlags they summarize and
+    lists the messages whose count is missing, wrong or left over.  With
+    --fix, recounts those messages (or, with --rebuild, every message)."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fix', action='store_true', dest='fix', default=False,
+                    help='recount the messages found to be out of step'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help='recount every message, without checking first'),
+        make_option('--show', dest='show', type='int', default=20,
+                    help='number of inconsistent messages to list'),
+    )
+
+    def inconsistent(self):
+        """ returns (message pk, flags, counted flags) for every message out of step """
+        qn = connection.ops.quote_name
+        names = {'summary': qn(FlaggedMessage._meta.db_table), 'flags': qn(MessageFlag._meta.db_table)}
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT f.message_id, f.flags, s.flag_count
+              FROM (SELECT message_id, COUNT(*) AS flags FROM %(flags)s GROUP BY message_id) f
+              LEFT JOIN %(summary)s s ON s.message_id = f.message_id
+             WHERE s.flag_count IS NULL OR s.flag_count <> f.flags
+            UNION ALL
+            SELECT s.message_id, 0, s.flag_count
+              FROM %(summary)s s
+             WHERE NOT EXISTS (SELECT 1 FROM %(flags)s f WHERE f.message_id = s.message_id)""" % names)
+        return cursor.fetchall()
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        if options['rebuild']:
+            written = refresh_flagged_messages()
+            self.stdout.write("%d flagged messages counted\n" % written)
+            return
+        rows = self.inconsistent()
+        if not rows:
+            self.stdout.write("flag counts are consistent\n")
+            return
+        self.stdout.write("%d messages have inconsistent flag counts\n" % len(rows))
+        for pk, flags, counted in rows[:options['show']]:
+            self.stdout.write("  message %d: %d flags, counted %s\n" % (pk, flags, counted))
+        if options['fix']:
+            pks = [row[0] for row in rows]
+            refresh_flagged_messages(pks)
+            self.stdout.write("%d messages recounted\n" % len(pks))
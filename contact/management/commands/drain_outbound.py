@@ -0,0 +1,43 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from contact.outbound import Drainer, FakeSender, get_sender, metrics
+
+
+class Command(BaseCommand):
+    help = """Releases the messages queued by the outbound scheduler (with
+    CONTACT_OUTBOUND_SCHEDULER on) to the router, each backend no faster than
+    its CONTACT_OUTBOUND_RATES token bucket allows.  Run a single drainer."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='exit once nothing is due instead of waiting for more'),
+        make_option('--fake', action='store_true', dest='fake', default=False,
+                    help='hand messages to a fake backend that only records them'),
+        make_option('--fake-failure-rate', dest='failure_rate', type='float', default=0.0,
+                    help='share of messages the fake backend fails'),
+        make_option('--report-every', dest='report_every', type='int', default=60,
+                    help='seconds between queue depth and send rate reports'),
+    )
+
+    def report(self):
+        for backend, stats in sorted(metrics().items()):
+            self.stdout.write("%-20s %8d queued %8d due %8d failed %8.2f/s\n" % (
+                backend, stats['queued'], stats['due'], stats['failed'], stats['per_second']))
+
+    def handle(self, **options):
+        sender = FakeSender(options['failure_rate']) if options['fake'] else get_sender()
+        drainer = Drainer(sender)
+        reported = time.time()
+        while True:
+            handled, wait = drainer.drain()
+            if time.time() - reported >= options['report_every']:
+                self.report()
+                reported = time.time()
+            if wait is None:
+                if options['once']:
+                    break
+                time.sleep(1)
+            elif not handled:
+                time.sleep(max(wait, 0.05))
+        self.report()
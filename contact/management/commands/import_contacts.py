@@ -0,0 +1,35 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from contact.importer import ContactImporter, ContactImportError, read_rows, IMPORT_BATCH_SIZE, COUNTRY_CODE
+
+
+class Command(BaseCommand):
+    args = '<file.csv|file.xlsx>'
+    help = """Creates a contact and a connection for every row of a csv or xlsx contact
+    list whose phone number isn't known yet.  The first row names the
+    columns: phone, and optionally name, backend and location."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--backend', dest='backend', default=None,
+                    help='name of the backend for rows without a backend column'),
+        make_option('--country-code', dest='country_code', default=COUNTRY_CODE,
+                    help='calling code that replaces the leading 0 of national numbers'),
+        make_option('--batch-size', dest='batch_size', type='int', default=IMPORT_BATCH_SIZE),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='check the file without writing anything'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import")
+        importer = ContactImporter(backend=options['backend'], country_code=options['country_code'],
+                                   batch_size=options['batch_size'], dry_run=options['dry_run'])
+        try:
+            importer.run(read_rows(open(args[0], 'rb'), args[0]))
+        except (ContactImportError, IOError), e:
+            raise CommandError(e)
+        for line, reason in importer.errors:
+            self.stdout.write("line %d: %s\n" % (line, reason.encode('utf-8')))
+        self.stdout.write("%d rows: %d contacts %s, %d numbers already known, %d repeated, %d rejected\n" % (
+            importer.rows, importer.created, 'to create' if importer.dry_run else 'created',
+            importer.existing, importer.repeated, importer.invalid))
@@ -0,0 +1,20 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from contact.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = """Creates the full-text index used by the CONTACT_MESSAGE_SEARCH_BACKEND
+    setting, if it doesn't exist yet.  New messages are indexed as they arrive."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help='re-index every message'),
+    )
+
+    def handle(self, **options):
+        backend = get_search_backend()
+        backend.install()
+        if options['rebuild']:
+            backend.rebuild()
+        self.stdout.write("Message search index ready (%s)\n" % backend.__class__.__name__)
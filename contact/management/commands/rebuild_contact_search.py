@@ -0,0 +1,37 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rapidsms.models import Contact, Connection
+from contact.models import ContactSearchTerm, index_contacts, index_connections
+
+
+def chunks(queryset, chunk_size):
+    """ yields the values_list rows of ``queryset``, whose first column is the pk, a chunk at a time """
+    last_pk = None
+    while True:
+        chunk = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = """Rebuilds the contact search index from scratch.  Run it after imports
+    that skip the save signals; the migration indexes the existing contacts."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=5000),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        connection.cursor().execute("DELETE FROM %s" % ContactSearchTerm._meta.db_table)
+        transaction.set_dirty()
+        contacts = Contact.objects.order_by('pk').values_list('pk', 'name', 'reporting_location__name')
+        for chunk in chunks(contacts, options['chunk_size']):
+            index_contacts(chunk)
+        connections = Connection.objects.exclude(contact=None).order_by('pk').values_list('pk', 'contact', 'identity')
+        for chunk in chunks(connections, options['chunk_size']):
+            index_connections(chunk)
+        self.stdout.write("%d search terms written\n" % ContactSearchTerm.objects.count())
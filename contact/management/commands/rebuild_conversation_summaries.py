@@ -0,0 +1,21 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from contact.models import rebuild_conversation_summaries
+
+
+class Command(BaseCommand):
+    help = """Recomputes the per-connection conversation summaries from the message table.
+    Run it once after migrating, after imports, and on a schedule (nightly, say)
+    on sites where other apps send in bulk, e.g. poll's Message.mass_text: those
+    skip the save signals that keep the summaries up to date."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--connection', action='append', dest='connections', type='int',
+                    help='only rebuild the summary of this connection (may be repeated)'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        written = rebuild_conversation_summaries(options['connections'])
+        self.stdout.write("%d conversation summaries written\n" % written)
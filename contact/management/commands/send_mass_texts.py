@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from contact.sending import claim_mass_text, run_mass_text, MASS_TEXT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = """Sends the mass texts queued from the web interface (with
+    CONTACT_ASYNC_MASS_TEXT on), a batch of recipients at a time, recording
+    progress on each MassText.  Several workers can run side by side."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=MASS_TEXT_BATCH_SIZE,
+                    help='contacts sent to per transaction'),
+        make_option('--sleep', dest='sleep', type='float', default=5,
+                    help='seconds to wait when there is nothing to send'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='exit once the queue is empty instead of waiting for more'),
+    )
+
+    def handle(self, **options):
+        while True:
+            masstext = claim_mass_text()
+            if masstext is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write("sending mass text %d to %d connections\n" % (masstext.pk, masstext.recipient_count))
+            if run_mass_text(masstext, options['batch_size']):
+                self.stdout.write("mass text %d done\n" % masstext.pk)
+            else:
+                self.stdout.write("mass text %d was taken over by another worker\n" % masstext.pk)
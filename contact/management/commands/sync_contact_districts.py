@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rapidsms.models import Contact
+from rapidsms.contrib.locations.models import Location
+from contact.models import within_location
+
+
+class Command(BaseCommand):
+    help = """Recomputes every Contact's district from its reporting_location, a district
+    at a time.  Run it after bulk imports, which skip the save signals, and
+    after the location tree changes."""
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        changed = 0
+        for district in Location.objects.filter(type__slug='district'):
+            inside = within_location(district, 'reporting_location')
+            changed += Contact.objects.filter(district=district).exclude(inside).update(district=None)
+            changed += Contact.objects.filter(inside).exclude(district=district).update(district=district)
+        changed += Contact.objects.filter(reporting_location=None).exclude(district=None).update(district=None)
+        self.stdout.write("%d contacts updated\n" % changed)
@@ -0,0 +1,171 @@
+import re
+from bisect import bisect_right
+from django.conf import settings
+from contact.cache import get_generation
+from contact.models import Flag, MessageFlag, FLAG_MATCHER_GENERATION, count_flags
+
+FLAG_REGEX_FLAGS = re.IGNORECASE | re.UNICODE
+
+
+class FlagMatcher(object):
+    """
+    Evaluates every Flag rule against a message text with a single pass of
+    one combined pattern, instead of running each Flag's rule_regex in turn.
+
+    The combined pattern is a zero-width lookahead over the alternation of
+    all flag words (longest first), so it records a hit at every position
+    where some word starts, even where hits overlap.  A word that is a
+    prefix of the longest hit at a position is credited alongside it, which
+    keeps the result identical to searching each word's \\bword\\b on its
+    own.  Hits remember the line they start on, because the contains_all_of
+    lookaheads built by Flag.get_regex() only see a single line.
+    """
+
+    def __init__(self, flags):
+        self.rules = []
+        words = set()
+        for flag in flags:
+            flag_words = [w.lower() for w in flag.get_words()]
+            if not flag_words or flag.rule not in (Flag.contains_all_of, Flag.contains_one_of):
+                continue
+            self.rules.append((flag, flag.rule, flag_words))
+            words.update(flag_words)
+        self.compile(words)
+
+    def compile(self, words):
+        ordered = sorted(words, key=lambda w: (-len(w), w))
+        self.pattern = None
+        if ordered:
+            self.pattern = re.compile(r"(?=\b(%s)\b)" % "|".join([re.escape(w) for w in ordered]),
+                                      FLAG_REGEX_FLAGS)
+        self.prefixes = {}
+        for word in ordered:
+            self.prefixes[word] = [w for w in ordered if len(w) < len(word) and word.startswith(w)
+                                   and re.match(r"%s\b" % re.escape(w), word, FLAG_REGEX_FLAGS)]
+
+    def hits(self, text):
+        """
+        Returns a dict mapping every flag word found in ``text`` to the set
+        of line numbers it was found on.
+        """
+        hits = {}
+        if self.pattern is None or not text:
+            return hits
+        newlines = [m.start() for m in re.finditer("\n", text)] if "\n" in text else []
+        for match in self.pattern.finditer(text):
+            line = bisect_right(newlines, match.start())
+            word = match.group(1).lower()
+            for w in [word] + self.prefixes.get(word, []):
+                hits.setdefault(w, set()).add(line)
+        return hits
+
+    def match(self, text):
+        """
+        Returns the Flags whose rule matches ``text``.
+        """
+        hits = self.hits(text)
+        if not hits:
+            return []
+        matched = []
+        for flag, rule, words in self.rules:
+            if rule == Flag.contains_one_of:
+                if [w for w in words if w in hits]:
+                    matched.append(flag)
+            else:
+                lines = None
+                for w in words:
+                    lines = hits.get(w, set()) if lines is None else lines & hits.get(w, set())
+                    if not lines:
+                        break
+                if lines:
+                    matched.append(flag)
+        return matched
+
+
+class TokenSetMatcher(FlagMatcher):
+    """
+    Evaluates Flag rules by splitting each line of a message into a set of
+    lower-cased word tokens once, then testing flag words with set lookups,
+    so the cost no longer grows with the number of words times the length
+    of the text the way stacked contains_all_of lookaheads do.
+
+    A flag word made of a single run of word characters is present exactly
+    when it is one of the tokens, which is what \\bword\\b tests.  Phrases
+    and words with punctuation have no token equivalent; those fall back to
+    their own \\bword\\b pattern, searched line by line.
+    """
+    TOKEN = re.compile(r"\w+", FLAG_REGEX_FLAGS)
+
+    def compile(self, words):
+        self.tokens = set()
+        self.patterns = []
+        for word in words:
+            token = self.TOKEN.match(word)
+            if token and token.end() == len(word):
+                self.tokens.add(word)
+            else:
+                self.patterns.append((word, re.compile(r"\b%s\b" % re.escape(word), FLAG_REGEX_FLAGS)))
+
+    def hits(self, text):
+        hits = {}
+        if not text:
+            return hits
+        for line, line_text in enumerate(text.split("\n")):
+            for token in self.tokens.intersection(self.TOKEN.findall(line_text.lower())):
+                hits.setdefault(token, set()).add(line)
+            for word, pattern in self.patterns:
+                if pattern.search(line_text):
+                    hits.setdefault(word, set()).add(line)
+        return hits
+
+
+MATCHERS = {
+    'regex': FlagMatcher,
+    'tokens': TokenSetMatcher,
+}
+
+
+def get_matcher_class():
+    """
+    Returns the matcher class selected by the CONTACT_FLAG_EVALUATION
+    setting, either 'regex' (the default) or 'tokens'.
+    """
+    return MATCHERS[getattr(settings, 'CONTACT_FLAG_EVALUATION', 'regex')]
+
+
+_matcher = None
+_matcher_generation = None
+
+
+def get_flag_matcher():
+    """
+    Returns this process's FlagMatcher, rebuilding it whenever a Flag has
+    been saved or deleted (in this or any other process) since it was built.
+    """
+    global _matcher, _matcher_generation
+    generation = get_generation(FLAG_MATCHER_GENERATION)
+    if _matcher is None or generation is None or generation != _matcher_generation:
+        _matcher = get_matcher_class()(Flag.objects.exclude(rule=None).exclude(words=None))
+        _matcher_generation = generation
+    return _matcher
+
+
+def apply_flags(message):
+    """
+    Scans a saved incoming Message once and attaches a MessageFlag for
+    every Flag it matches, using a single bulk insert, and counts them in
+    the message's FlaggedMessage.
+    """
+    flags = get_flag_matcher().match(message.text)
+    if not flags:
+        return []
+    # (message, flag) is unique, so skip flags a re-run has already applied
+    existing = set(MessageFlag.objects.filter(message=message).values_list('flag', flat=True))
+    flags = [flag for flag in flags if flag.pk not in existing]
+    if not flags:
+        return []
+    for flag in flags:
+        MessageFlag.bulk.bulk_insert(send_pre_save=False, message=message, flag=flag)
+    MessageFlag.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+    count_flags(message.pk, len(flags))
+    return flags
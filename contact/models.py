@@ -1,11 +1,21 @@
-from django.db import models
+from django.db import models, connection as db_connection, transaction, IntegrityError
+from django.db.models import Q, F
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.sites.managers import CurrentSiteManager
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 from rapidsms_httprouter.managers import BulkInsertManager
 from rapidsms_httprouter.models import Message
-from rapidsms.models import Contact, Connection
+from rapidsms.models import Contact, Connection, Backend
+from rapidsms.contrib.locations.models import Location
+from contact.cache import bump_generation
+from contact.recipients import RecipientSet, decoded_pks, contains_pk
+import datetime
 import re
+import unicodedata
+
+# shared cache key that moves on whenever any Flag changes, see contact.matching
+FLAG_MATCHER_GENERATION = 'contact-flag-matcher-generation'
 
 c_bulk_mgr = BulkInsertManager()
 c_bulk_mgr.contribute_to_class(Contact, 'bulk')
@@ -14,16 +24,96 @@ cn_bulk_mgr = BulkInsertManager()
 cn_bulk_mgr.contribute_to_class(Connection, 'bulk')
 
 
+class MassTextManager(models.Manager):
+
+    def sent_to(self, contact):
+        """
+        Returns the mass texts sent to ``contact``, whether its recipients
+        are kept as a RecipientSet or, for older texts, in ``contacts``.
+        Only texts whose range of recipient pks covers the contact are
+        looked into, and their decoded sets are kept for the next lookup.
+        """
+        contact_pk = getattr(contact, 'pk', contact)
+        candidates = list(self.exclude(recipients_data=None)
+                          .filter(min_contact_pk__lte=contact_pk, max_contact_pk__gte=contact_pk)
+                          .values_list('pk', flat=True))
+
+        def load(pk):
+            return RecipientSet(self.filter(pk=pk).values_list('recipients_data', flat=True)[0])
+
+        compact = [pk for pk in candidates
+                   if contains_pk(decoded_pks(('masstext', pk), lambda: load(pk)), contact_pk)]
+        return self.filter(Q(contacts=contact_pk) | Q(pk__in=compact)).distinct()
+
+
 class MassText(models.Model):
+    """
+    A message sent to many contacts at once.  Texts sent from the web
+    request are sent as soon as they are created; with
+    CONTACT_ASYNC_MASS_TEXT they are queued instead, and ``manage.py
+    send_mass_texts`` sends them in batches, recording its progress here
+    (see contact.sending).
+    """
+    queued = 'Q'
+    sending = 'S'
+    sent = 'C'
+    failed = 'F'
+
     sites = models.ManyToManyField(Site)
-    contacts = models.ManyToManyField(Contact, related_name='masstexts')
+    # only filled in for texts sent before recipients_data; contact.masstexts
+    # (see the MassTextContact extension) answers for every text
+    contacts = models.ManyToManyField(Contact, related_name='legacy_masstexts')
     user = models.ForeignKey(User)
     date = models.DateTimeField(auto_now_add=True, null=True)
     text = models.TextField()
-    objects = models.Manager()
+    status = models.CharField(max_length=1, default=sent, db_index=True,
+                              choices=((queued, "queued"), (sending, "sending"), (sent, "sent"), (failed, "failed"),))
+    # the recipient contacts as a RecipientSet (see contact.recipients);
+    # texts sent before it existed keep theirs in ``contacts``
+    recipients_data = models.TextField(null=True)
+    contact_count = models.PositiveIntegerField(default=0)
+    # the range of recipient pks, which narrows down the texts sent_to decodes
+    min_contact_pk = models.IntegerField(null=True)
+    max_contact_pk = models.IntegerField(null=True)
+    # progress of a queued text: connections to send to, sent and failed so
+    # far, and the pk of the last contact handled
+    recipient_count = models.PositiveIntegerField(default=0)
+    sent_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    last_contact_id = models.IntegerField(default=0)
+    last_error = models.TextField(null=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    heartbeat = models.DateTimeField(null=True)
+    objects = MassTextManager()
     on_site = CurrentSiteManager('sites')
     bulk = BulkInsertManager()
 
+    def in_progress(self):
+        return self.status in (MassText.queued, MassText.sending)
+
+    def _get_recipients(self):
+        if not hasattr(self, '_recipients'):
+            if self.recipients_data is not None:
+                self._recipients = RecipientSet(self.recipients_data, self.contact_count)
+            else:
+                self._recipients = RecipientSet.from_pks(self.contacts.values_list('pk', flat=True))
+        return self._recipients
+
+    def _set_recipients(self, recipients):
+        self._recipients = recipients
+        self.recipients_data, self.contact_count = recipients.data, len(recipients)
+        self.min_contact_pk, self.max_contact_pk = recipients.bounds()
+
+    recipients = property(_get_recipients, _set_recipients)
+
+    def get_contact_count(self):
+        # older texts have no contact_count, only rows in ``contacts``
+        return self.contact_count or self.contacts.count()
+
+    def was_sent_to(self, contact):
+        return getattr(contact, 'pk', contact) in self.recipients
+
     class Meta:
         permissions = (
             ("can_message", "Can send messages, create polls, etc"),
@@ -48,8 +138,11 @@ class Flag(models.Model):
         message_flags = self.messages.values_list('message', flat=True)
         return Message.objects.filter(pk__in=message_flags)
 
+    def get_words(self):
+        return [w.strip() for w in (self.words or "").split(",") if len(w.strip()) > 0]
+
     def get_regex(self):
-        words = [w.strip() for w in self.words.split(",") if len(w) > 0]
+        words = self.get_words()
 
         if self.rule == 1:
             all_template = r"(?=.*\b%s\b)"
@@ -72,7 +165,8 @@ class Flag(models.Model):
     def save(self, *args, **kwargs):
         if self.words:
             self.rule_regex = self.get_regex()
-        super(Flag, self).save()
+        super(Flag, self).save(*args, **kwargs)
+        bump_generation(FLAG_MATCHER_GENERATION)
 
     def __unicode__(self):
         return self.name
@@ -83,7 +177,472 @@ class MessageFlag(models.Model):
     """
     message = models.ForeignKey(Message, related_name='flags')
     flag = models.ForeignKey(Flag, related_name="messages", null=True)
+    objects = models.Manager()
+    bulk = BulkInsertManager()
+
+    class Meta:
+        unique_together = (('message', 'flag'),)
 
     def flags(self):
-        mf = MessageFlag.objects.filter(message=self.message).values_list("flag", flat=True)
-        return Flag.objects.filter(pk__in=mf)
+        return Flag.objects.filter(messages__message=self.message)
+
+    @staticmethod
+    def get_flag_map(messages):
+        """
+        Returns a dict mapping the pk of every flagged message in
+        ``messages`` (Message objects or pks) to the names of its flags,
+        using a single query.  Flags set by hand have no Flag and show up
+        as None; unflagged messages are left out of the dict.
+        """
+        pks = [getattr(m, 'pk', m) for m in messages]
+        flag_map = {}
+        if pks:
+            for message_pk, name in MessageFlag.objects.filter(message__in=pks).values_list('message', 'flag__name'):
+                flag_map.setdefault(message_pk, []).append(name)
+        return flag_map
+
+
+def flag_deleted(sender, **kwargs):
+    bump_generation(FLAG_MATCHER_GENERATION)
+
+post_delete.connect(flag_deleted, sender=Flag)
+
+
+class FlaggedMessage(models.Model):
+    """
+    One row for every flagged message, holding the number of flags it
+    carries, so that filtering messages on whether they are flagged is a
+    primary key lookup instead of an outer join against MessageFlag.  Kept
+    up to date by the MessageFlag save and delete signals and by the bulk
+    paths that skip them (contact.bulk, contact.matching and the
+    backfill_flags command); ``manage.py check_flagged_messages`` reports
+    and repairs any drift.
+    """
+    message = models.OneToOneField(Message, primary_key=True, related_name='flag_summary')
+    flag_count = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u"%s: %d flags" % (self.message_id, self.flag_count)
+
+
+def count_flags(message_id, delta):
+    """
+    Adds ``delta`` (possibly negative) to the flag count of a message,
+    creating its FlaggedMessage on the first flag and removing it with the
+    last.
+    """
+    summaries = FlaggedMessage.objects.filter(message=message_id)
+    if delta < 0:
+        summaries.filter(flag_count__lte=-delta).delete()
+        summaries.update(flag_count=F('flag_count') + delta)
+        return
+    if not delta or summaries.update(flag_count=F('flag_count') + delta):
+        return
+    sid = transaction.savepoint()
+    try:
+        FlaggedMessage.objects.create(message_id=message_id, flag_count=delta)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # created by a concurrent flag in the meantime
+        transaction.savepoint_rollback(sid)
+        summaries.update(flag_count=F('flag_count') + delta)
+
+
+def message_flag_saved(sender, **kwargs):
+    if kwargs.get('created') and not kwargs.get('raw'):
+        count_flags(kwargs['instance'].message_id, 1)
+
+
+def message_flag_deleted(sender, **kwargs):
+    count_flags(kwargs['instance'].message_id, -1)
+
+post_save.connect(message_flag_saved, sender=MessageFlag)
+post_delete.connect(message_flag_deleted, sender=MessageFlag)
+
+
+def within_location(location, prefix='location'):
+    """
+    Returns a Q matching rows whose ``prefix`` relation points at
+    ``location`` or anywhere below it, as one MPTT range predicate instead
+    of an IN list of all its descendants.
+    """
+    return Q(**{'%s__tree_id' % prefix: location.tree_id,
+                '%s__lft__gte' % prefix: location.lft,
+                '%s__rght__lte' % prefix: location.rght})
+
+
+def get_district(location):
+    """ returns the district ``location`` lies in (possibly itself), or None """
+    if location is None:
+        return None
+    districts = Location.objects.filter(type__slug='district', tree_id=location.tree_id,
+                                        lft__lte=location.lft, rght__gte=location.rght)
+    return (list(districts[:1]) or [None])[0]
+
+
+def sync_contact_district(sender, **kwargs):
+    contact = kwargs['instance']
+    if contact.reporting_location_id is None:
+        contact.district = None
+    elif getattr(contact, '_district_location_id', None) != contact.reporting_location_id:
+        contact.district = get_district(contact.reporting_location)
+    contact._district_location_id = contact.reporting_location_id
+
+pre_save.connect(sync_contact_district, sender=Contact)
+
+
+class ConversationSummary(models.Model):
+    """
+    Running totals of the messages exchanged with a connection, so that a
+    message history or contact list reads one row instead of counting the
+    message table.  Kept up to date as messages are created and deleted,
+    and by record_sent for the messages this app's bulk send paths write
+    without save signals.
+
+    Messages other apps write in bulk, like poll's Message.mass_text, and
+    queryset updates or raw deletes of the message table, don't reach
+    them, so on sites using those the totals drift until
+    ``manage.py rebuild_conversation_summaries`` recomputes them from the
+    message table; schedule it (nightly, say) there.
+    """
+    connection = models.OneToOneField(Connection, related_name='conversation_summary')
+    incoming = models.PositiveIntegerField(default=0)
+    outgoing = models.PositiveIntegerField(default=0)
+    first_message_date = models.DateTimeField(null=True)
+    last_message_date = models.DateTimeField(null=True)
+    last_incoming = models.ForeignKey(Message, null=True, related_name='conversation_summaries',
+                                      on_delete=models.SET_NULL)
+    last_incoming_date = models.DateTimeField(null=True)
+
+    @staticmethod
+    def for_contact(contact):
+        """
+        Returns the combined summary of all of a contact's connections: a
+        dict of incoming, outgoing, first_message_date, last_message_date
+        and last_incoming (the latest incoming Message, or None).
+        """
+        summaries = ConversationSummary.objects.filter(connection__contact=contact).select_related('last_incoming')
+        return ConversationSummary.combine(summaries)
+
+    @staticmethod
+    def combine(summaries):
+        totals = {'incoming': 0, 'outgoing': 0, 'first_message_date': None,
+                  'last_message_date': None, 'last_incoming': None}
+        last_incoming_date = None
+        for summary in summaries:
+            totals['incoming'] += summary.incoming
+            totals['outgoing'] += summary.outgoing
+            first, last = summary.first_message_date, summary.last_message_date
+            if first is not None and (totals['first_message_date'] is None or first < totals['first_message_date']):
+                totals['first_message_date'] = first
+            if last is not None and (totals['last_message_date'] is None or last > totals['last_message_date']):
+                totals['last_message_date'] = last
+            if summary.last_incoming_id and (last_incoming_date is None or
+                                             summary.last_incoming_date > last_incoming_date):
+                totals['last_incoming'] = summary.last_incoming
+                last_incoming_date = summary.last_incoming_date
+        return totals
+
+    def __unicode__(self):
+        return u"%s: %d in, %d out" % (self.connection, self.incoming, self.outgoing)
+
+
+def record_message(message):
+    """
+    Adds a newly created message to its connection's ConversationSummary.
+    Messages almost always arrive newest-last, which costs one UPDATE;
+    backdated messages and the first message of a connection take a couple
+    more queries.
+    """
+    date = message.date
+    counter = 'incoming' if message.direction == 'I' else 'outgoing'
+    counts = {counter: F(counter) + 1}
+    latest = {'last_message_date': date}
+    if message.direction == 'I':
+        latest.update(last_incoming=message, last_incoming_date=date)
+    summaries = ConversationSummary.objects.filter(connection=message.connection_id)
+    newest = Q(last_message_date=None) | Q(last_message_date__lte=date)
+    if summaries.filter(newest).update(**dict(counts, **latest)):
+        return
+    if not summaries.update(**counts):
+        sid = transaction.savepoint()
+        try:
+            ConversationSummary.objects.create(connection_id=message.connection_id,
+                                               first_message_date=date, **dict(latest, **{counter: 1}))
+            transaction.savepoint_commit(sid)
+            return
+        except IntegrityError:
+            # created by a concurrent message in the meantime
+            transaction.savepoint_rollback(sid)
+            if summaries.filter(newest).update(**dict(counts, **latest)):
+                return
+            summaries.update(**counts)
+    summaries.filter(first_message_date__gt=date).update(first_message_date=date)
+    if message.direction == 'I':
+        summaries.filter(Q(last_incoming_date=None) | Q(last_incoming_date__lt=date)) \
+            .update(last_incoming=message, last_incoming_date=date)
+
+
+# connections whose summaries record_sent updates per statement
+SUMMARY_CHUNK_SIZE = 1000
+
+
+def record_sent(connection_ids, date=None):
+    """
+    Adds outgoing messages written by the bulk managers, which skip the
+    save signal record_message hangs off, to their connections'
+    summaries: one message per entry of ``connection_ids``, all sent at
+    ``date`` (now by default).  Missing summaries are created with one
+    INSERT ... SELECT and the rest updated a chunk of connections at a time.
+    """
+    date = date or datetime.datetime.now()
+    counts = {}
+    for connection_id in connection_ids:
+        counts[connection_id] = counts.get(connection_id, 0) + 1
+    if not counts:
+        return
+    ids = sorted(counts)
+    values = {
+        'summary': db_connection.ops.quote_name(ConversationSummary._meta.db_table),
+        'connection': db_connection.ops.quote_name(Connection._meta.db_table),
+    }
+    cursor = db_connection.cursor()
+    for start in range(0, len(ids), SUMMARY_CHUNK_SIZE):
+        chunk = ids[start:start + SUMMARY_CHUNK_SIZE]
+        insert = """
+            INSERT INTO %(summary)s (connection_id, incoming, outgoing, first_message_date, last_message_date)
+            SELECT c.id, 0, 0, %%s, %%s FROM %(connection)s c
+             WHERE c.id IN (%(ids)s)
+               AND NOT EXISTS (SELECT 1 FROM %(summary)s s WHERE s.connection_id = c.id)""" % dict(
+            values, ids=", ".join(["%s"] * len(chunk)))
+        sid = transaction.savepoint()
+        try:
+            cursor.execute(insert, [date, date] + chunk)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # a concurrent message created one of them in the meantime
+            transaction.savepoint_rollback(sid)
+            cursor.execute(insert, [date, date] + chunk)
+    transaction.set_dirty()
+    by_count = {}
+    for connection_id, count in counts.items():
+        by_count.setdefault(count, []).append(connection_id)
+    for count, connections in by_count.items():
+        for start in range(0, len(connections), SUMMARY_CHUNK_SIZE):
+            summaries = ConversationSummary.objects.filter(connection__in=connections[start:start + SUMMARY_CHUNK_SIZE])
+            summaries.update(outgoing=F('outgoing') + count)
+            summaries.filter(Q(last_message_date=None) | Q(last_message_date__lt=date)).update(last_message_date=date)
+            summaries.filter(Q(first_message_date=None) | Q(first_message_date__gt=date)).update(first_message_date=date)
+
+
+def message_created(sender, **kwargs):
+    if kwargs.get('created') and not kwargs.get('raw'):
+        record_message(kwargs['instance'])
+
+post_save.connect(message_created, sender=Message)
+
+
+def forget_message(message):
+    """
+    Takes a deleted message back out of its connection's
+    ConversationSummary.  Usually that is one UPDATE of a counter; when the
+    message was the first, last or latest incoming one of its connection
+    the summary's dates are recomputed with rebuild_conversation_summaries.
+    """
+    date = message.date
+    summaries = ConversationSummary.objects.filter(connection=message.connection_id)
+    edges = Q(first_message_date=date) | Q(last_message_date=date)
+    if message.direction == 'I':
+        edges |= Q(last_incoming_date=date)
+    if summaries.filter(edges).exists():
+        rebuild_conversation_summaries([message.connection_id])
+        return
+    counter = 'incoming' if message.direction == 'I' else 'outgoing'
+    summaries.filter(**{'%s__gt' % counter: 0}).update(**{counter: F(counter) - 1})
+
+
+def message_deleted(sender, **kwargs):
+    forget_message(kwargs['instance'])
+
+post_delete.connect(message_deleted, sender=Message)
+
+
+def rebuild_conversation_summaries(connections=None):
+    """
+    Recomputes the ConversationSummary of ``connections`` (a list of
+    Connection pks, or every connection when None) from the message table,
+    with one INSERT ... SELECT.  Returns the number of summaries written.
+    """
+    values = {
+        'summary': ConversationSummary._meta.db_table,
+        'message': Message._meta.db_table,
+    }
+    where, params = "", []
+    summaries = ConversationSummary.objects.all()
+    if connections is not None:
+        if not connections:
+            return 0
+        where = "WHERE m.connection_id IN (%s)" % ", ".join(["%s"] * len(connections))
+        params = list(connections)
+        summaries = summaries.filter(connection__in=connections)
+    summaries.delete()
+    cursor = db_connection.cursor()
+    cursor.execute("""
+        INSERT INTO %(summary)s (connection_id, incoming, outgoing, first_message_date,
+                                 last_message_date, last_incoming_id, last_incoming_date)
+        SELECT connection_id, incoming, outgoing, first_message_date, last_message_date,
+               (SELECT l.id FROM %(message)s l
+                 WHERE l.connection_id = t.connection_id AND l.direction = 'I'
+                 ORDER BY l.date DESC, l.id DESC LIMIT 1),
+               last_incoming_date
+          FROM (SELECT m.connection_id AS connection_id,
+                       SUM(CASE WHEN m.direction = 'I' THEN 1 ELSE 0 END) AS incoming,
+                       SUM(CASE WHEN m.direction = 'I' THEN 0 ELSE 1 END) AS outgoing,
+                       MIN(m.date) AS first_message_date,
+                       MAX(m.date) AS last_message_date,
+                       MAX(CASE WHEN m.direction = 'I' THEN m.date END) AS last_incoming_date
+                  FROM %(message)s m
+                  %(where)s
+                 GROUP BY m.connection_id) t""" % dict(values, where=where), params)
+    transaction.set_dirty()
+    return cursor.rowcount
+
+
+class OutboundMessage(models.Model):
+    """
+    An outgoing message held back by the outbound scheduler (see
+    contact.outbound) until its backend's rate limit and its not_before
+    time let ``manage.py drain_outbound`` release it to the router.
+    """
+    queued = 'Q'
+    released = 'S'
+    failed = 'F'
+
+    connection = models.ForeignKey(Connection, related_name='scheduled_messages')
+    # the connection's backend, kept here to queue and count per backend without a join
+    backend = models.ForeignKey(Backend, related_name='scheduled_messages')
+    text = models.TextField()
+    in_response_to = models.ForeignKey(Message, null=True, related_name='scheduled_responses')
+    created = models.DateTimeField(auto_now_add=True)
+    not_before = models.DateTimeField()
+    status = models.CharField(max_length=1, default=queued,
+                              choices=((queued, "queued"), (released, "released"), (failed, "failed"),))
+    attempts = models.PositiveIntegerField(default=0)
+    released_at = models.DateTimeField(null=True, db_index=True)
+    last_error = models.TextField(null=True)
+    objects = models.Manager()
+    bulk = BulkInsertManager()
+
+    def __unicode__(self):
+        return u"%s to %s" % (self.text, self.connection)
+
+
+class ContactSearchTerm(models.Model):
+    """
+    The words a contact can be found by on the contact list: its name
+    tokens, its reporting location's name tokens, and the digits of each of
+    its phone numbers written backwards, so that a search for the last
+    digits of a number is a prefix lookup on the term index.  Kept up to
+    date as contacts, connections and locations are saved; ``manage.py
+    rebuild_contact_search`` rebuilds it after bulk imports.
+    """
+    name = 'n'
+    location = 'l'
+    phone = 'p'
+
+    contact = models.ForeignKey(Contact, related_name='search_terms')
+    # set on phone terms, so they follow their connection
+    connection = models.ForeignKey(Connection, null=True, related_name='search_terms')
+    kind = models.CharField(max_length=1, choices=((name, "name"), (location, "location"), (phone, "phone"),))
+    term = models.CharField(max_length=100, db_index=True)
+    objects = models.Manager()
+    bulk = BulkInsertManager()
+
+
+SEARCH_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def search_tokens(text):
+    """ the lowercased, accent-stripped words of ``text`` """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', unicode(text))
+    text = u"".join([c for c in text if not unicodedata.combining(c)]).lower()
+    return sorted(set([token[:100] for token in SEARCH_TOKEN.findall(text)]))
+
+
+def phone_term(identity):
+    """ the digits of a phone number, last digit first """
+    digits = re.sub(r"\D", "", identity or "")
+    return digits[::-1][:100]
+
+
+def _add_terms(contact_id, kind, terms, connection_id=None):
+    added = 0
+    for term in terms:
+        if term:
+            ContactSearchTerm.bulk.bulk_insert(send_pre_save=False, contact_id=contact_id,
+                                               connection_id=connection_id, kind=kind, term=term)
+            added += 1
+    return added
+
+
+def _commit_terms(added):
+    if added:
+        ContactSearchTerm.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+
+
+def index_contacts(rows):
+    """
+    Writes the name and location terms of ``rows``, (contact pk, name,
+    location name) tuples, through the bulk manager.
+    """
+    added = 0
+    for contact_id, name, location_name in rows:
+        added += _add_terms(contact_id, ContactSearchTerm.name, search_tokens(name))
+        added += _add_terms(contact_id, ContactSearchTerm.location, search_tokens(location_name))
+    _commit_terms(added)
+
+
+def index_connections(rows):
+    """ writes the phone terms of ``rows``, (connection pk, contact pk, identity) tuples """
+    added = 0
+    for connection_id, contact_id, identity in rows:
+        if contact_id:
+            added += _add_terms(contact_id, ContactSearchTerm.phone, [phone_term(identity)], connection_id)
+    _commit_terms(added)
+
+
+def contact_saved(sender, **kwargs):
+    contact = kwargs['instance']
+    if kwargs.get('raw'):
+        return
+    ContactSearchTerm.objects.filter(contact=contact, kind__in=[ContactSearchTerm.name, ContactSearchTerm.location]).delete()
+    location_name = contact.reporting_location.name if contact.reporting_location_id else None
+    index_contacts([(contact.pk, contact.name, location_name)])
+
+
+def connection_saved(sender, **kwargs):
+    connection = kwargs['instance']
+    if kwargs.get('raw'):
+        return
+    ContactSearchTerm.objects.filter(connection=connection).delete()
+    index_connections([(connection.pk, connection.contact_id, connection.identity)])
+
+
+def location_saved(sender, **kwargs):
+    location = kwargs['instance']
+    if kwargs.get('raw') or kwargs.get('created'):
+        return
+    terms = ContactSearchTerm.objects.filter(kind=ContactSearchTerm.location, contact__reporting_location=location)
+    terms.delete()
+    contact_ids = Contact.objects.filter(reporting_location=location).values_list('pk', flat=True)
+    tokens = search_tokens(location.name)
+    added = 0
+    for contact_id in contact_ids.iterator():
+        added += _add_terms(contact_id, ContactSearchTerm.location, tokens)
+    _commit_terms(added)
+
+post_save.connect(contact_saved, sender=Contact)
+post_save.connect(connection_saved, sender=Connection)
+post_save.connect(location_saved, sender=Location)
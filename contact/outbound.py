@@ -0,0 +1,270 @@
+import datetime
+import logging
+import random
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils.importlib import import_module
+from rapidsms.models import Connection
+from rapidsms_httprouter.models import Message
+from contact.models import OutboundMessage, record_sent
+
+logger = logging.getLogger(__name__)
+
+# (messages per second, burst) for each backend name; 'default' covers the rest
+DEFAULT_RATES = {'default': (5, 20)}
+
+# a blast is released no faster than this many messages per second, however
+# many tokens its backend has, so one blast can't starve everything else;
+# None releases blasts as fast as the backends allow
+BLAST_RATE = getattr(settings, 'CONTACT_OUTBOUND_BLAST_RATE', None)
+
+# responses read and queued per statement by queue_replies
+QUEUE_CHUNK_SIZE = getattr(settings, 'CONTACT_RECIPIENT_CHUNK_SIZE', 1000)
+
+MAX_ATTEMPTS = getattr(settings, 'CONTACT_OUTBOUND_MAX_ATTEMPTS', 3)
+RETRY_DELAY = 30
+
+
+def outbound_scheduler():
+    """ whether messages from the contact actions go through the scheduler """
+    return getattr(settings, 'CONTACT_OUTBOUND_SCHEDULER', False)
+
+
+def get_rates():
+    rates = dict(DEFAULT_RATES)
+    rates.update(getattr(settings, 'CONTACT_OUTBOUND_RATES', {}))
+    return rates
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` messages a second on average and up to ``burst`` at
+    once.  ``clock`` can be replaced to drive it in tests.
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self.refill()
+        return int(self.tokens)
+
+    def take(self, count):
+        self.refill()
+        self.tokens -= count
+
+    def wait(self):
+        """ seconds until the next token """
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def _enqueue(rows, not_before):
+    for connection_id, backend_id, text, in_response_to_id, index in rows:
+        OutboundMessage.bulk.bulk_insert(send_pre_save=False,
+                                         connection_id=connection_id,
+                                         backend_id=backend_id,
+                                         text=text,
+                                         in_response_to_id=in_response_to_id,
+                                         created=datetime.datetime.now(),
+                                         not_before=not_before(index),
+                                         status=OutboundMessage.queued,
+                                         attempts=0)
+    OutboundMessage.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+
+
+class Blast(object):
+    """
+    Queues one text to many connections, a chunk at a time.  With
+    BLAST_RATE set, the messages are scheduled one after the other at that
+    rate from the moment the blast started.
+    """
+
+    def __init__(self, text, rate=BLAST_RATE):
+        self.text = text
+        self.rate = rate
+        self.start = datetime.datetime.now()
+        self.count = 0
+
+    def not_before(self, index):
+        if not self.rate:
+            return self.start
+        return self.start + datetime.timedelta(seconds=index / float(self.rate))
+
+    def add(self, connection_ids):
+        if not connection_ids:
+            return
+        backends = dict(Connection.objects.filter(pk__in=connection_ids).values_list('pk', 'backend'))
+        rows = []
+        for connection_id in connection_ids:
+            rows.append((connection_id, backends[connection_id], self.text, None, self.count))
+            self.count += 1
+        _enqueue(rows, self.not_before)
+
+
+@transaction.commit_on_success
+def queue_replies(text, messages, chunk_size=QUEUE_CHUNK_SIZE):
+    """
+    Queues ``text`` as a response to each of the Message queryset
+    ``messages``, reading and writing them a chunk at a time in pk order,
+    all in one transaction.  Returns the number of responses queued.
+    """
+    rows = messages.order_by('pk').values_list('pk', 'connection', 'connection__backend')
+    now = datetime.datetime.now()
+    count, last_pk = 0, None
+    while True:
+        chunk = list((rows if last_pk is None else rows.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return count
+        last_pk = chunk[-1][0]
+        _enqueue([(connection_id, backend_id, text, pk, 0) for pk, connection_id, backend_id in chunk],
+                 lambda index: now)
+        count += len(chunk)
+
+
+class RouterSender(object):
+    """
+    Releases messages to the router by queueing them as outgoing Messages,
+    which the router's own sender then delivers.
+    """
+
+    def send(self, backend, messages):
+        for pk, connection_id, text, in_response_to_id in messages:
+            Message.bulk.bulk_insert(send_pre_save=False,
+                                     text=text,
+                                     direction='O',
+                                     status='Q',
+                                     connection_id=connection_id,
+                                     in_response_to_id=in_response_to_id,
+                                     priority=10)
+        Message.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+        record_sent([connection_id for pk, connection_id, text, in_response_to_id in messages])
+        return []
+
+
+class FakeSender(object):
+    """
+    A stand-in backend for trying the scheduler out: it records what it is
+    given in ``sent`` (backend name, message pk, release time), and fails
+    a ``failure_rate`` share of the messages.
+    """
+    sent = []
+
+    def __init__(self, failure_rate=0.0):
+        self.failure_rate = failure_rate
+
+    def send(self, backend, messages):
+        failed = []
+        for message in messages:
+            if random.random() < self.failure_rate:
+                failed.append((message[0], "fake failure"))
+            else:
+                FakeSender.sent.append((backend, message[0], time.time()))
+        return failed
+
+
+def get_sender():
+    path = getattr(settings, 'CONTACT_OUTBOUND_SENDER', 'contact.outbound.RouterSender')
+    module, name = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module), name)()
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured("CONTACT_OUTBOUND_SENDER %s can't be loaded: %s" % (path, e))
+
+
+class Drainer(object):
+    """
+    Releases due OutboundMessages through ``sender``, each backend as fast
+    as its token bucket allows.  The buckets live in this process, so run
+    a single drainer.
+    """
+
+    def __init__(self, sender, rates=None, clock=time.time):
+        self.sender = sender
+        self.rates = rates or get_rates()
+        self.clock = clock
+        self.buckets = {}
+
+    def bucket(self, backend):
+        if backend not in self.buckets:
+            rate, burst = self.rates.get(backend, self.rates['default'])
+            self.buckets[backend] = TokenBucket(rate, burst, self.clock)
+        return self.buckets[backend]
+
+    @transaction.commit_on_success
+    def drain_backend(self, backend_id, backend, limit):
+        now = datetime.datetime.now()
+        due = OutboundMessage.objects.filter(status=OutboundMessage.queued, backend=backend_id, not_before__lte=now)
+        messages = list(due.order_by('not_before', 'pk')
+                        .values_list('pk', 'connection', 'text', 'in_response_to')[:limit])
+        if not messages:
+            return 0
+        failed = dict(self.sender.send(backend, messages))
+        released = [m[0] for m in messages if m[0] not in failed]
+        if released:
+            OutboundMessage.objects.filter(pk__in=released).update(status=OutboundMessage.released, released_at=now)
+        for pk, error in failed.items():
+            logger.warning("outbound message %d through %s failed: %s" % (pk, backend, error))
+            retry = OutboundMessage.objects.filter(pk=pk)
+            retry.update(attempts=F('attempts') + 1, last_error=error,
+                         not_before=now + datetime.timedelta(seconds=RETRY_DELAY))
+            retry.filter(attempts__gte=MAX_ATTEMPTS).update(status=OutboundMessage.failed)
+        return len(messages)
+
+    def drain(self):
+        """
+        Releases what every backend's bucket allows right now.  Returns the
+        number of messages handed to the sender and the seconds to wait
+        before more can go, or None for the wait when nothing is due.
+        """
+        backends = OutboundMessage.objects.filter(status=OutboundMessage.queued,
+                                                  not_before__lte=datetime.datetime.now()) \
+            .values_list('backend', 'backend__name').distinct()
+        handled, waits = 0, []
+        for backend_id, backend in backends:
+            bucket = self.bucket(backend)
+            available = bucket.available()
+            if available:
+                count = self.drain_backend(backend_id, backend, available)
+                bucket.take(count)
+                handled += count
+            waits.append(bucket.wait())
+        return handled, min(waits) if waits else None
+
+
+def metrics(window=60):
+    """
+    Queue depth and release rate per backend: {backend name: {'queued',
+    'due', 'failed', 'per_second'}}, the rate taken over the last
+    ``window`` seconds.
+    """
+    now = datetime.datetime.now()
+    since = now - datetime.timedelta(seconds=window)
+    result = {}
+
+    def add(queryset, key):
+        for row in queryset.values('backend__name').annotate(count=Count('pk')):
+            stats = result.setdefault(row['backend__name'],
+                                      {'queued': 0, 'due': 0, 'failed': 0, 'per_second': 0.0})
+            stats[key] = row['count']
+
+    queued = OutboundMessage.objects.filter(status=OutboundMessage.queued)
+    add(queued, 'queued')
+    add(queued.filter(not_before__lte=now), 'due')
+    add(OutboundMessage.objects.filter(status=OutboundMessage.failed), 'failed')
+    add(OutboundMessage.objects.filter(released_at__gte=since), 'per_second')
+    for stats in result.values():
+        stats['per_second'] = stats['per_second'] / float(window)
+    return result
@@ -0,0 +1,160 @@
+import base64
+import datetime
+from django.db.models import Q
+from django.utils import simplejson
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(value, pk):
+    """
+    Encodes a (sort value, pk) position as an opaque, url-safe token.
+    """
+    if value is None:
+        kind = 'n'
+    elif isinstance(value, datetime.datetime):
+        kind, value = 'd', value.isoformat()
+    else:
+        kind = 's'
+    return base64.urlsafe_b64encode(simplejson.dumps([kind, value, pk]))
+
+
+def decode_cursor(token):
+    try:
+        kind, value, pk = simplejson.loads(base64.urlsafe_b64decode(str(token)))
+        pk = int(pk)
+    except (TypeError, ValueError):
+        raise InvalidCursor(token)
+    if kind == 'n':
+        return None, pk
+    if kind == 'd':
+        for fmt in DATETIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, fmt), pk
+            except ValueError:
+                pass
+        raise InvalidCursor(token)
+    return value, pk
+
+
+class KeysetPage(object):
+
+    def __init__(self, paginator, object_list, has_next, has_previous):
+        self.paginator = paginator
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return self.paginator.cursor_for(self.object_list[-1])
+
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return self.paginator.cursor_for(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    Pages through a queryset by seeking past the (sort column, pk) of the
+    last row seen instead of counting rows with OFFSET, so every page costs
+    the same however deep it is, and page boundaries don't shift when new
+    rows are added in front of them.  No total count is computed.
+
+    Rows whose sort column is NULL are kept together after the others in
+    ascending order (and before them in descending order), ordered by pk,
+    which makes the ordering the same on every database.
+    """
+
+    def __init__(self, queryset, per_page, sort_column='pk', ascending=True):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.sort_column = sort_column
+        self.ascending = ascending
+
+    def value_for(self, obj):
+        value = obj
+        for attr in self.sort_column.split('__'):
+            value = getattr(value, attr, None)
+            if value is None:
+                return None
+        return value
+
+    def cursor_for(self, obj):
+        if self.sort_column == 'pk':
+            return encode_cursor(obj.pk, obj.pk)
+        return encode_cursor(self.value_for(obj), obj.pk)
+
+    def _segments(self, ascending):
+        col = self.sort_column
+        pk = 'pk' if ascending else '-pk'
+        if col == 'pk':
+            return [(None, [pk])]
+        values = (Q(**{'%s__isnull' % col: False}), [col if ascending else '-%s' % col, pk])
+        nulls = (Q(**{'%s__isnull' % col: True}), [pk])
+        return [values, nulls] if ascending else [nulls, values]
+
+    def _after(self, value, pk, ascending, is_null_segment):
+        gt = 'gt' if ascending else 'lt'
+        if self.sort_column == 'pk' or is_null_segment:
+            return Q(**{'pk__%s' % gt: pk})
+        return Q(**{'%s__%s' % (self.sort_column, gt): value}) | Q(**{self.sort_column: value, 'pk__%s' % gt: pk})
+
+    def _seek(self, cursor, ascending, limit):
+        """
+        Returns up to ``limit`` rows strictly after ``cursor`` (a decoded
+        (value, pk) pair, or None for the start) in the given direction.
+        """
+        segments = self._segments(ascending)
+        start = 0
+        if cursor is not None and self.sort_column != 'pk':
+            # a NULL sort value means the cursor sits in the NULL segment
+            null_index = 1 if ascending else 0
+            start = null_index if cursor[0] is None else 1 - null_index
+        rows = []
+        for index in range(start, len(segments)):
+            condition, ordering = segments[index]
+            queryset = self.queryset
+            if condition is not None:
+                queryset = queryset.filter(condition)
+            if cursor is not None and index == start:
+                is_null_segment = self.sort_column != 'pk' and cursor[0] is None
+                queryset = queryset.filter(self._after(cursor[0], cursor[1], ascending, is_null_segment))
+            rows.extend(queryset.order_by(*ordering)[:limit - len(rows)])
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def page(self, after=None, before=None):
+        """
+        Returns the page following the ``after`` cursor, the page preceding
+        the ``before`` cursor, or the first page when neither is given.
+        """
+        if before is not None:
+            rows = self._seek(decode_cursor(before), not self.ascending, self.per_page + 1)
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            return KeysetPage(self, rows, True, has_previous)
+        cursor = decode_cursor(after) if after is not None else None
+        rows = self._seek(cursor, self.ascending, self.per_page + 1)
+        return KeysetPage(self, rows[:self.per_page], len(rows) > self.per_page, cursor is not None)
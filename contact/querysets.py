@@ -0,0 +1,258 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.backends.util import typecast_timestamp
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.hashcompat import md5_constructor
+from rapidsms_httprouter.models import Message
+from poll.models import Poll, Response
+from generic.sorters import Sorter
+from contact.models import MassText, MessageFlag
+
+try:
+    from rapidsms_xforms.models import XFormSubmission
+except ImportError:
+    XFormSubmission = None
+
+# rows are handed to the prefetchers in batches of this size; a page of the
+# message log fits in one batch, so rendering it costs a fixed number of queries
+PREFETCH_BATCH_SIZE = 100
+
+
+class PrefetchQuerySet(QuerySet):
+    """
+    A QuerySet that passes the rows it yields, a batch at a time, to a
+    bundle of prefetchers.  Each prefetcher loads related data for the
+    whole batch with one query and attaches it to the objects, so templates
+    can read it without a query per row.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PrefetchQuerySet, self).__init__(*args, **kwargs)
+        self._prefetchers = ()
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        c = super(PrefetchQuerySet, self)._clone(klass, setup, **kwargs)
+        c._prefetchers = self._prefetchers
+        return c
+
+    def prefetch_bundle(self, *prefetchers):
+        c = self._clone()
+        c._prefetchers = self._prefetchers + prefetchers
+        return c
+
+    def iterator(self):
+        if not self._prefetchers:
+            for obj in super(PrefetchQuerySet, self).iterator():
+                yield obj
+            return
+        batch = []
+        for obj in super(PrefetchQuerySet, self).iterator():
+            batch.append(obj)
+            if len(batch) >= PREFETCH_BATCH_SIZE:
+                for obj in self._prefetch(batch):
+                    yield obj
+                batch = []
+        for obj in self._prefetch(batch):
+            yield obj
+
+    def _prefetch(self, batch):
+        if batch:
+            for prefetcher in self._prefetchers:
+                prefetcher(batch)
+        return batch
+
+
+class CountCacheQuerySet(QuerySet):
+    """
+    A QuerySet whose count() is cached for CONTACT_COUNT_CACHE_TIMEOUT
+    seconds, keyed by the SQL of the filtered query without its ordering,
+    so that re-sorting or paging through the same filtered list reuses one
+    COUNT(*).  count() is always exact, since paginators trust it to
+    find the last page.
+    """
+
+    def count_signature(self):
+        query = self.query.clone()
+        query.clear_ordering(True)
+        sql, params = query.get_compiler(self.db).as_sql()
+        return md5_constructor(("%s:%s:%r" % (self.db, sql, params)).encode('utf-8')).hexdigest()
+
+    def _cached(self, prefix, compute):
+        try:
+            key = 'contact-%s-%s' % (prefix, self.count_signature())
+        except EmptyResultSet:
+            return 0
+        count = cache.get(key)
+        if count is None:
+            count = compute()
+            cache.set(key, count, getattr(settings, 'CONTACT_COUNT_CACHE_TIMEOUT', 60))
+        return count
+
+    def count(self):
+        if self._result_cache is not None and not self._iter:
+            return len(self._result_cache)
+        return self._cached('count', super(CountCacheQuerySet, self).count)
+
+
+class MessageRowQuerySet(PrefetchQuerySet, CountCacheQuerySet):
+    pass
+
+
+def attach_flag_names(messages):
+    """
+    Sets ``flag_names`` on every message in ``messages`` with one query.
+    """
+    messages = [m for m in messages if not hasattr(m, 'flag_names')]
+    flag_map = MessageFlag.get_flag_map(messages)
+    for message in messages:
+        message.flag_names = flag_map.get(message.pk, [])
+
+
+def attach_responses(messages):
+    """
+    Sets ``prefetched_responses`` on every message to the list of messages
+    sent in response to it.
+    """
+    responses = {}
+    for response in Message.objects.filter(in_response_to__in=[m.pk for m in messages]).order_by('date', 'pk'):
+        responses.setdefault(response.in_response_to_id, []).append(response)
+    for message in messages:
+        message.prefetched_responses = responses.get(message.pk, [])
+
+
+def _first_errors(model, messages):
+    errors = {}
+    for message_pk, has_errors in model.objects.filter(message__in=[m.pk for m in messages]) \
+            .order_by('-pk').values_list('message', 'has_errors'):
+        errors[message_pk] = has_errors
+    return errors
+
+
+def attach_handler_errors(messages):
+    """
+    Sets ``handler_has_errors`` on every message handled by the poll or
+    xforms app, from its first poll response or xform submission.
+    """
+    polls = [m for m in messages if m.application == 'poll']
+    xforms = [m for m in messages if m.application == 'rapidsms_xforms']
+    errors = {}
+    if polls:
+        errors.update(_first_errors(Response, polls))
+    if xforms and XFormSubmission is not None:
+        errors.update(_first_errors(XFormSubmission, xforms))
+    for message in messages:
+        message.handler_has_errors = errors.get(message.pk, False)
+
+
+MESSAGE_ROW_BUNDLE = (attach_responses, attach_handler_errors, attach_flag_names)
+
+
+def message_row_queryset(queryset):
+    """
+    Turns a Message queryset into one that loads everything
+    contact/partials/message_row.html shows for a whole page at once:
+    connections and contacts are joined in, responses, poll/xform error
+    state and flags are prefetched per batch.
+    """
+    return queryset.select_related('connection__contact')._clone(klass=MessageRowQuerySet) \
+        .prefetch_bundle(*MESSAGE_ROW_BUNDLE)
+
+
+class MassMessageList(object):
+    """
+    The polls and mass texts shown on the mass messages page, as one
+    UNION ALL query that the database sorts and pages: count() and slicing
+    only ever fetch what the page shows.  Rows are (text, date, username,
+    recipient count, type, MassText or None) tuples.
+    """
+    columns = ('text', 'date', 'user', 'recipients', 'type')
+
+    def __init__(self, sort_column='date', ascending=False):
+        if sort_column not in self.columns:
+            raise ValueError("can't sort mass messages by %s" % sort_column)
+        self.sort_column = sort_column
+        self.ascending = ascending
+        self._count = None
+
+    def order_by(self, column, ascending=True):
+        return MassMessageList(column, ascending)
+
+    def count(self):
+        if self._count is None:
+            self._count = Poll.objects.exclude(start_date=None).count() + MassText.objects.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def union_sql(self):
+        qn = connection.ops.quote_name
+        poll_contacts = Poll._meta.get_field('contacts')
+        masstext_contacts = MassText._meta.get_field('contacts')
+        return """
+            SELECT p.question AS %(text)s, p.start_date AS %(date)s, u.username AS %(user)s,
+                   (SELECT COUNT(*) FROM %(poll_contacts)s pc WHERE pc.%(poll_id)s = p.id) AS %(recipients)s,
+                   'Poll Message' AS %(type)s, p.id AS %(id)s
+              FROM %(poll)s p INNER JOIN %(users)s u ON u.id = p.user_id
+             WHERE p.start_date IS NOT NULL
+            UNION ALL
+            SELECT m.text, m.date, u.username,
+                   CASE WHEN m.contact_count > 0 THEN m.contact_count
+                        ELSE (SELECT COUNT(*) FROM %(masstext_contacts)s mc WHERE mc.%(masstext_id)s = m.id) END,
+                   'Mass Text', m.id
+              FROM %(masstext)s m INNER JOIN %(users)s u ON u.id = m.user_id""" % dict(
+            [(name, qn(name)) for name in self.columns + ('id',)],
+            poll=qn(Poll._meta.db_table),
+            poll_contacts=qn(poll_contacts.m2m_db_table()),
+            poll_id=qn(poll_contacts.m2m_column_name()),
+            masstext=qn(MassText._meta.db_table),
+            masstext_contacts=qn(masstext_contacts.m2m_db_table()),
+            masstext_id=qn(masstext_contacts.m2m_column_name()),
+            users=qn(User._meta.db_table))
+
+    def fetch(self, offset, limit):
+        qn = connection.ops.quote_name
+        direction = "ASC" if self.ascending else "DESC"
+        sql = "SELECT * FROM (%s) mass_messages ORDER BY %s %s, %s %s, %s %s" % (
+            self.union_sql(), qn(self.sort_column), direction, qn('type'), direction, qn('id'), direction)
+        params = []
+        if limit is not None:
+            sql += " LIMIT %s OFFSET %s"
+            params = [limit, offset]
+        elif offset:
+            raise ValueError("mass messages can only be sliced with a stop")
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        masstexts = MassText.objects.defer('recipients_data').in_bulk(
+            [row[5] for row in rows if row[4] == 'Mass Text'])
+        result = []
+        for text, date, username, recipients, kind, pk in rows:
+            if isinstance(date, basestring):
+                date = typecast_timestamp(date)
+            result.append((text, date, username, recipients, kind,
+                           masstexts.get(pk) if kind == 'Mass Text' else None))
+        return result
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start = k.start or 0
+            limit = None if k.stop is None else max(k.stop - start, 0)
+            return self.fetch(start, limit)
+        rows = self.fetch(k, 1)
+        if not rows:
+            raise IndexError(k)
+        return rows[0]
+
+    def __iter__(self):
+        return iter(self.fetch(0, None))
+
+
+class MassMessageSorter(Sorter):
+    """ sorts a MassMessageList in the database """
+
+    def sort(self, column, object_list, ascending=True):
+        return object_list.order_by(column, ascending)
@@ -0,0 +1,151 @@
+import base64
+import zlib
+from array import array
+from bisect import bisect_left
+from django.conf import settings
+
+# bytes decompressed at a time while iterating a set
+READ_SIZE = 8192
+
+# decoded pks kept in memory by decoded_pks, over all the sets it holds
+DECODED_CACHE_SIZE = getattr(settings, 'CONTACT_RECIPIENT_CACHE_SIZE', 2000000)
+
+
+class RecipientSetWriter(object):
+    """
+    Builds the compact encoding of a set of contact pks from ascending
+    chunks of them: the gaps between consecutive pks as base-128 varints,
+    deflated, then base64 encoded to fit a text column.  Dense id ranges
+    cost well under a byte per recipient.
+    """
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(9)
+        self.parts = []
+        self.first = None
+        self.last = 0
+        self.count = 0
+
+    def add(self, pks):
+        encoded = []
+        for pk in pks:
+            if pk <= self.last:
+                raise ValueError("recipient pks must be added in ascending order, got %d after %d" % (pk, self.last))
+            if self.first is None:
+                self.first = pk
+            gap = pk - self.last
+            while gap >= 0x80:
+                encoded.append(chr((gap & 0x7f) | 0x80))
+                gap >>= 7
+            encoded.append(chr(gap))
+            self.last = pk
+            self.count += 1
+        self.parts.append(self.compressor.compress("".join(encoded)))
+
+    def finish(self):
+        """ returns the encoded set, its size, and its smallest and largest pks """
+        self.parts.append(self.compressor.flush())
+        return base64.b64encode("".join(self.parts)), self.count, self.first, self.last or None
+
+
+class RecipientSet(object):
+    """
+    A read-only, sorted set of contact pks decoded from the text a
+    RecipientSetWriter produced.  Iteration decompresses as it goes, so a
+    large set is never expanded in memory as a whole.
+    """
+
+    def __init__(self, data, count=None, first=None, last=None):
+        self.data = data
+        self.count = count
+        self.first = first
+        self.last = last
+
+    @classmethod
+    def from_pks(cls, pks):
+        writer = RecipientSetWriter()
+        writer.add(sorted(set(pks)))
+        return cls(*writer.finish())
+
+    def _bytes(self):
+        decompressor = zlib.decompressobj()
+        compressed = base64.b64decode(self.data)
+        for start in range(0, len(compressed), READ_SIZE):
+            for byte in decompressor.decompress(compressed[start:start + READ_SIZE]):
+                yield ord(byte)
+        for byte in decompressor.flush():
+            yield ord(byte)
+
+    def __iter__(self):
+        pk = gap = shift = 0
+        for byte in self._bytes():
+            gap |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                pk += gap
+                yield pk
+                gap = shift = 0
+
+    def __len__(self):
+        if self.count is None:
+            self.count = sum([1 for pk in self])
+        return self.count
+
+    def __contains__(self, pk):
+        for member in self:
+            if member >= pk:
+                return member == pk
+        return False
+
+    def bounds(self):
+        """ the smallest and largest pks, or (None, None) for an empty set """
+        if self.first is None:
+            for pk in self:
+                if self.first is None:
+                    self.first = pk
+                self.last = pk
+        return self.first, self.last
+
+    def sorted_pks(self):
+        return array('l', self)
+
+    def chunks(self, size, after=0):
+        """ yields the pks greater than ``after`` in ascending lists of up to ``size`` """
+        chunk = []
+        for pk in self:
+            if pk <= after:
+                continue
+            chunk.append(pk)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+_decoded = {}
+_decoded_order = []
+
+
+def decoded_pks(key, load):
+    """
+    Returns the sorted array of pks of the set cached under ``key``,
+    calling ``load()`` for its RecipientSet when it isn't cached.  Sets
+    never change once written, so the arrays are kept, least recently
+    used dropped first, up to DECODED_CACHE_SIZE pks in all.
+    """
+    if key in _decoded:
+        _decoded_order.remove(key)
+    else:
+        _decoded[key] = load().sorted_pks()
+        while len(_decoded_order) and sum([len(pks) for pks in _decoded.values()]) > DECODED_CACHE_SIZE:
+            del _decoded[_decoded_order.pop(0)]
+    _decoded_order.append(key)
+    return _decoded[key]
+
+
+def contains_pk(pks, pk):
+    """ whether the sorted array ``pks`` holds ``pk`` """
+    index = bisect_left(pks, pk)
+    return index < len(pks) and pks[index] == pk
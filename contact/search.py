@@ -0,0 +1,237 @@
+import re
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from rapidsms_httprouter.models import Message
+from contact.models import ContactSearchTerm, search_tokens, phone_term
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_query(query):
+    """
+    Splits a free-text query into alternatives separated by 'or', each a
+    list of required terms.  A term is its text, its word tokens and
+    whether it is a phrase: a bare word is matched as a prefix, a "quoted
+    phrase" (or a word with punctuation inside) needs its tokens next to
+    each other, in order.
+
+    >>> parse_query('water "borehole broken" or dry')
+    [[('water', ['water'], False), ('borehole broken', ['borehole', 'broken'], True)], [('dry', ['dry'], False)]]
+    """
+    alternatives = [[]]
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        if word and word.lower() == 'or':
+            if alternatives[-1]:
+                alternatives.append([])
+            continue
+        text = phrase or word
+        tokens = [t.lower() for t in TOKEN.findall(text)]
+        if tokens:
+            alternatives[-1].append((text, tokens, bool(phrase) or len(tokens) > 1))
+    return [a for a in alternatives if a]
+
+
+class SearchBackend(object):
+    """
+    The default backend: every term is a case-insensitive substring match,
+    which needs no index but scans the whole message table.
+    """
+
+    def filter(self, queryset, query):
+        alternatives = parse_query(query)
+        if not alternatives:
+            return queryset
+        q = None
+        for terms in alternatives:
+            alternative = Q()
+            for text, tokens, is_phrase in terms:
+                alternative &= Q(text__icontains=text)
+            q = alternative if q is None else q | alternative
+        return queryset.filter(q)
+
+    def install(self):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class SqliteSearchBackend(SearchBackend):
+    """
+    Searches an FTS5 index over message text, kept up to date by triggers
+    on the message table.
+    """
+    table = 'contact_message_fts'
+
+    def match_expression(self, alternatives):
+        def quote(token):
+            return '"%s"' % token.replace('"', '""')
+        expressions = []
+        for terms in alternatives:
+            parts = []
+            for text, tokens, is_phrase in terms:
+                if is_phrase:
+                    parts.append(quote(" ".join(tokens)))
+                else:
+                    parts.append("%s*" % quote(tokens[0]))
+            expressions.append("(%s)" % " AND ".join(parts))
+        return " OR ".join(expressions)
+
+    def filter(self, queryset, query):
+        alternatives = parse_query(query)
+        if not alternatives:
+            return queryset
+        return queryset.extra(
+            where=['"%s"."%s" IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                Message._meta.db_table, Message._meta.pk.column, self.table, self.table)],
+            params=[self.match_expression(alternatives)])
+
+    @transaction.commit_on_success
+    def install(self):
+        values = {
+            'fts': self.table,
+            'messages': Message._meta.db_table,
+            'id': Message._meta.pk.column,
+        }
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [self.table])
+        exists = cursor.fetchone()
+        for statement in (
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5(text, content='%(messages)s', content_rowid='%(id)s')",
+            "CREATE TRIGGER IF NOT EXISTS %(fts)s_insert AFTER INSERT ON %(messages)s BEGIN "
+            "INSERT INTO %(fts)s(rowid, text) VALUES (new.%(id)s, new.text); END",
+            "CREATE TRIGGER IF NOT EXISTS %(fts)s_delete AFTER DELETE ON %(messages)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, text) VALUES ('delete', old.%(id)s, old.text); END",
+            "CREATE TRIGGER IF NOT EXISTS %(fts)s_update AFTER UPDATE OF text ON %(messages)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, text) VALUES ('delete', old.%(id)s, old.text); "
+            "INSERT INTO %(fts)s(rowid, text) VALUES (new.%(id)s, new.text); END",
+        ):
+            cursor.execute(statement % values)
+        if not exists:
+            # index the messages that arrived before the triggers did
+            cursor.execute("INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')" % values)
+        transaction.set_dirty()
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        connection.cursor().execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (self.table, self.table))
+        transaction.set_dirty()
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Searches message text through a GIN index on its tsvector, which
+    postgres maintains itself as messages are inserted.  Phrases need
+    postgres 9.6 or later.
+    """
+    index = 'contact_message_text_tsv'
+    config = 'simple'
+
+    def tsquery(self, alternatives):
+        def lexeme(token):
+            return "'%s'" % token.replace("\\", "\\\\").replace("'", "''")
+        expressions = []
+        for terms in alternatives:
+            parts = []
+            for text, tokens, is_phrase in terms:
+                if is_phrase:
+                    parts.append("(%s)" % " <-> ".join([lexeme(t) for t in tokens]))
+                else:
+                    parts.append("%s:*" % lexeme(tokens[0]))
+            expressions.append("(%s)" % " & ".join(parts))
+        return " | ".join(expressions)
+
+    def filter(self, queryset, query):
+        alternatives = parse_query(query)
+        if not alternatives:
+            return queryset
+        return queryset.extra(
+            where=["to_tsvector('%s', \"%s\".\"text\") @@ to_tsquery('%s', %%s)" % (
+                self.config, Message._meta.db_table, self.config)],
+            params=[self.tsquery(alternatives)])
+
+    @transaction.commit_on_success
+    def install(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [self.index])
+        if not cursor.fetchone():
+            cursor.execute("CREATE INDEX %s ON %s USING gin (to_tsvector('%s', text))" % (
+                self.index, Message._meta.db_table, self.config))
+            transaction.set_dirty()
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        connection.cursor().execute("REINDEX INDEX %s" % self.index)
+        transaction.set_dirty()
+
+
+BACKENDS = {
+    'icontains': SearchBackend,
+    'sqlite': SqliteSearchBackend,
+    'postgres': PostgresSearchBackend,
+}
+
+ENGINE_BACKENDS = {
+    'sqlite3': 'sqlite',
+    'postgresql_psycopg2': 'postgres',
+    'postgis': 'postgres',
+}
+
+
+def get_search_backend():
+    """
+    Returns the message search backend named by the
+    CONTACT_MESSAGE_SEARCH_BACKEND setting: 'icontains' (the default),
+    'sqlite', 'postgres', or 'auto' to pick the indexed backend for the
+    current database.  Indexed backends need ``manage.py
+    message_search_index`` to have been run once.
+    """
+    name = getattr(settings, 'CONTACT_MESSAGE_SEARCH_BACKEND', 'icontains')
+    if name == 'auto':
+        name = ENGINE_BACKENDS.get(connection.settings_dict['ENGINE'].split('.')[-1], 'icontains')
+    return BACKENDS[name]()
+
+
+PHONE_QUERY = re.compile(r"^\+?\d{3,}$")
+
+
+def contact_term_query(text, tokens, is_phrase):
+    """
+    Returns a Q matching the contacts found by one search term.  Three or
+    more digits are the end of a phone number, a range scan on the
+    reversed numbers.  Words match the start of a name or location word,
+    or the whole word when quoted.
+    """
+    if PHONE_QUERY.match(text):
+        suffix = phone_term(text)
+        # every reversed number that starts with suffix sorts between these two
+        terms = ContactSearchTerm.objects.filter(kind=ContactSearchTerm.phone, term__gte=suffix,
+                                                 term__lte=suffix + "9" * (100 - len(suffix)))
+        return Q(pk__in=terms.values('contact'))
+    q = Q()
+    for token in search_tokens(text):
+        lookup = {'term': token} if is_phrase else {'term__startswith': token}
+        terms = ContactSearchTerm.objects.filter(kind__in=[ContactSearchTerm.name, ContactSearchTerm.location],
+                                                 **lookup)
+        q &= Q(pk__in=terms.values('contact'))
+    return q
+
+
+def search_contacts(queryset, query):
+    """
+    Narrows a Contact queryset to the contacts matching ``query`` through
+    the ContactSearchTerm index: every term of one of the alternatives
+    separated by 'or' must match.  Each term is a semi-join, so no
+    contact is returned twice.
+    """
+    alternatives = parse_query(query)
+    if not alternatives:
+        return queryset
+    q = None
+    for terms in alternatives:
+        alternative = Q()
+        for term in terms:
+            alternative &= contact_term_query(*term)
+        q = alternative if q is None else q | alternative
+    return queryset.filter(q)
@@ -0,0 +1,241 @@
+import datetime
+import logging
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models import Q, F
+from rapidsms.models import Connection
+from rapidsms_httprouter.models import Message, MessageBatch
+from contact.models import MassText, record_sent
+from contact.recipients import RecipientSet, RecipientSetWriter
+from contact.outbound import outbound_scheduler, Blast
+
+logger = logging.getLogger(__name__)
+
+MASS_TEXT_BATCH_SIZE = getattr(settings, 'CONTACT_MASS_TEXT_BATCH_SIZE', 1000)
+
+# contacts resolved, recorded and sent to at a time by send_mass_text
+RECIPIENT_CHUNK_SIZE = getattr(settings, 'CONTACT_RECIPIENT_CHUNK_SIZE', 1000)
+
+# a text still marked as sending whose worker hasn't finished a batch for
+# this long is taken to be abandoned, and picked up by the next worker
+MASS_TEXT_STALE_AFTER = datetime.timedelta(minutes=getattr(settings, 'CONTACT_MASS_TEXT_STALE_MINUTES', 10))
+
+
+class MassTextLost(Exception):
+    """ raised when another worker has taken over the text being sent """
+    pass
+
+
+def async_mass_text():
+    return getattr(settings, 'CONTACT_ASYNC_MASS_TEXT', False)
+
+
+def contact_id_chunks(contacts, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Yields the pks of the contacts in the ``contacts`` queryset in lists of
+    up to ``chunk_size``, seeking by pk so that only one chunk is ever held.
+    """
+    ids = contacts.order_by('pk').values_list('pk', flat=True).distinct()
+    last_pk = None
+    while True:
+        chunk = list((ids if last_pk is None else ids.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1]
+        yield chunk
+
+
+def connection_id_chunks(contacts, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Yields (contact pks, pks of their connections) a chunk of contacts at a
+    time.
+    """
+    for contact_ids in contact_id_chunks(contacts, chunk_size):
+        yield contact_ids, list(Connection.objects.filter(contact__in=contact_ids).values_list('pk', flat=True))
+
+
+class BatchQueue(object):
+    """
+    Queues one text to many connections, a chunk at a time, in a single
+    MessageBatch, through the message bulk insert the way Message.mass_text
+    does, without loading the connections.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.batch = None
+
+    def add(self, connection_ids):
+        self.add_responses([(connection_id, None) for connection_id in connection_ids])
+
+    def add_responses(self, rows):
+        """ queues the text to each (connection pk, pk of the message it answers) in ``rows`` """
+        if not rows:
+            return
+        if self.batch is None:
+            self.batch = MessageBatch.objects.create(status='Q')
+        for connection_id, in_response_to_id in rows:
+            Message.bulk.bulk_insert(send_pre_save=False,
+                                     text=self.text,
+                                     direction='O',
+                                     status='P',
+                                     batch=self.batch,
+                                     connection_id=connection_id,
+                                     in_response_to_id=in_response_to_id,
+                                     priority=10)
+        Message.bulk.bulk_insert_commit(send_post_save=False, autoclobber=True)
+        record_sent([connection_id for connection_id, in_response_to_id in rows])
+
+
+def message_queue(text):
+    """
+    Returns what a mass text's messages are added to: the outbound
+    scheduler when it is on, otherwise a MessageBatch the router sends.
+    """
+    if outbound_scheduler():
+        return Blast(text)
+    return BatchQueue(text)
+
+
+@transaction.commit_on_success
+def send_replies(text, messages, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Replies ``text`` to every message in the ``messages`` queryset, in one
+    transaction and one MessageBatch, which the router sends as it does
+    any batch.  The selection is read a chunk at a time.  Returns the
+    number of replies queued.
+    """
+    queue = BatchQueue(text)
+    rows = messages.order_by('pk').values_list('pk', 'connection')
+    count, last_pk = 0, None
+    while True:
+        chunk = list((rows if last_pk is None else rows.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return count
+        last_pk = chunk[-1][0]
+        queue.add_responses([(connection_id, pk) for pk, connection_id in chunk])
+        count += len(chunk)
+
+
+@transaction.commit_on_success
+def send_mass_text(user, text, contacts, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Sends ``text`` from ``user`` to every connection of the contacts in the
+    ``contacts`` queryset and records the MassText, a chunk of contacts at
+    a time, so memory use doesn't grow with the number of recipients.
+    """
+    masstext = MassText(user=user, text=text)
+    queue = message_queue(text)
+    writer = RecipientSetWriter()
+    for contact_ids, connection_ids in connection_id_chunks(contacts, chunk_size):
+        writer.add(contact_ids)
+        queue.add(connection_ids)
+        masstext.recipient_count += len(connection_ids)
+    masstext.sent_count = masstext.recipient_count
+    masstext.recipients = RecipientSet(*writer.finish())
+    masstext.save()
+    if settings.SITE_ID:
+        masstext.sites.add(Site.objects.get_current())
+    return masstext
+
+
+@transaction.commit_on_success
+def queue_mass_text(user, text, contacts, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Records a MassText from ``user`` to every contact in the ``contacts``
+    queryset, to be sent by ``manage.py send_mass_texts``.
+    """
+    masstext = MassText(user=user, text=text, status=MassText.queued)
+    writer = RecipientSetWriter()
+    for contact_ids in contact_id_chunks(contacts, chunk_size):
+        writer.add(contact_ids)
+        masstext.recipient_count += Connection.objects.filter(contact__in=contact_ids).count()
+    masstext.recipients = RecipientSet(*writer.finish())
+    masstext.save()
+    if settings.SITE_ID:
+        masstext.sites.add(Site.objects.get_current())
+    return masstext
+
+
+def _claimable():
+    stale = datetime.datetime.now() - MASS_TEXT_STALE_AFTER
+    return Q(status=MassText.queued) | Q(status=MassText.sending, heartbeat__lt=stale)
+
+
+@transaction.commit_on_success
+def claim_mass_text():
+    """
+    Marks the oldest queued (or abandoned) MassText as being sent by this
+    worker and returns it, or returns None when there is nothing to send.
+    The conditional UPDATE makes sure two workers never claim the same one.
+    """
+    for pk in MassText.objects.filter(_claimable()).order_by('pk').values_list('pk', flat=True)[:10]:
+        now = datetime.datetime.now()
+        if MassText.objects.filter(_claimable(), pk=pk).update(status=MassText.sending, heartbeat=now):
+            MassText.objects.filter(pk=pk, started=None).update(started=now)
+            return MassText.objects.get(pk=pk)
+    return None
+
+
+def _advance(masstext, last_contact_id, **counts):
+    """
+    Moves ``masstext`` past the contacts up to ``last_contact_id``,
+    provided no other worker has moved it since this one read it.
+    """
+    updated = MassText.objects.filter(pk=masstext.pk, status=MassText.sending,
+                                      last_contact_id=masstext.last_contact_id) \
+        .update(last_contact_id=last_contact_id, heartbeat=datetime.datetime.now(),
+                **dict([(field, F(field) + count) for field, count in counts.items()]))
+    if not updated:
+        raise MassTextLost(masstext.pk)
+    masstext.last_contact_id = last_contact_id
+
+
+@transaction.commit_on_success
+def send_batch(masstext, queue, contact_ids, connection_ids):
+    """
+    Adds ``connection_ids``, the connections of ``contact_ids``, to
+    ``queue`` and records the progress in the same transaction, so a batch
+    is never sent twice.
+    """
+    queue.add(connection_ids)
+    _advance(masstext, contact_ids[-1], sent_count=len(connection_ids))
+
+
+@transaction.commit_on_success
+def skip_batch(masstext, contact_ids, connection_ids, error):
+    masstext.last_error = error
+    MassText.objects.filter(pk=masstext.pk).update(last_error=error)
+    _advance(masstext, contact_ids[-1], failed_count=len(connection_ids))
+
+
+def run_mass_text(masstext, batch_size=MASS_TEXT_BATCH_SIZE):
+    """
+    Sends a claimed MassText to its remaining recipients, the connections
+    of ``batch_size`` contacts at a time.  A batch that can't be sent is
+    counted as failed and skipped.  Returns False if another worker took
+    the text over.
+    """
+    queue = message_queue(masstext.text)
+    try:
+        for contact_ids in masstext.recipients.chunks(batch_size, after=masstext.last_contact_id):
+            connection_ids = list(Connection.objects.filter(contact__in=contact_ids).values_list('pk', flat=True))
+            batch = getattr(queue, 'batch', None)
+            try:
+                send_batch(masstext, queue, contact_ids, connection_ids)
+            except MassTextLost:
+                raise
+            except Exception, e:
+                if getattr(queue, 'batch', None) is not batch:
+                    # the MessageBatch the failed batch created was rolled back with it
+                    queue.batch = batch
+                logger.exception("mass text %d: sending to %d connections failed" % (masstext.pk, len(connection_ids)))
+                skip_batch(masstext, contact_ids, connection_ids, unicode(e))
+    except MassTextLost:
+        return False
+    masstext = MassText.objects.get(pk=masstext.pk)
+    status = MassText.failed if masstext.failed_count and not masstext.sent_count else MassText.sent
+    now = datetime.datetime.now()
+    MassText.objects.filter(pk=masstext.pk, status=MassText.sending).update(status=status, finished=now, heartbeat=now)
+    return True
@@ -0,0 +1,23 @@
+// refreshes the progress of mass texts that are still being sent
+function pollMassTextProgress() {
+    $('.masstext_progress').each(function() {
+        var span = $(this);
+        $.getJSON(span.attr('data-url'), function(data) {
+            var text = data.status_display + ': ' + data.sent + ' of ' + data.recipients + ' sent';
+            if (data.failed) {
+                text += ', ' + data.failed + ' failed';
+            }
+            span.text(text);
+            if (!data.in_progress) {
+                span.removeClass('masstext_progress');
+            }
+        });
+    });
+    if ($('.masstext_progress').length > 0) {
+        setTimeout(pollMassTextProgress, 5000);
+    }
+}
+
+$(document).ready(function() {
+    setTimeout(pollMassTextProgress, 5000);
+});
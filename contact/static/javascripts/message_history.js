@@ -15,9 +15,41 @@ $(document).ready(function() {
 	$(function() {    		
         $('.replyForm').hide();
 	});
+	$(window).scroll(loadOlderMessages);
 });
 
 
+var loadingOlderMessages = false;
+
+// appends the next page of the message history when the bottom of the
+// accordion scrolls into view
+function loadOlderMessages() {
+    var accordion = $('#accordion');
+    var next = accordion.attr('data-next');
+    if (loadingOlderMessages || !next) {
+        return;
+    }
+    if ($(window).scrollTop() + $(window).height() < accordion.offset().top + accordion.height() - 200) {
+        return;
+    }
+    loadingOlderMessages = true;
+    $('#message_history_loading').show();
+    $.getJSON(accordion.attr('data-url'), {after: next}, function(data) {
+        var active = accordion.accordion('option', 'active');
+        accordion.accordion('destroy').append(data.html);
+        accordion.accordion({ autoHeight: false, collapsible: true, active: active });
+        $('.replyForm', accordion).not(':has(#formcontent)').hide();
+        if (data.next) {
+            accordion.attr('data-next', data.next);
+        } else {
+            accordion.removeAttr('data-next');
+        }
+        $('#message_history_loading').hide();
+        loadingOlderMessages = false;
+    });
+}
+
+
 function collapse() {
     $('#show_results_list').show();
     $('#object_list').hide();
@@ -1,12 +1,85 @@
 from django import template
+from rapidsms_httprouter.models import STATUS_CHOICES, DIRECTION_CHOICES
 from contact.models import MessageFlag
+from contact.querysets import attach_flag_names, attach_responses, attach_handler_errors
+
+register = template.Library()
+
+STATUS_NAMES = dict(STATUS_CHOICES)
+DIRECTION_NAMES = dict(DIRECTION_CHOICES)
 
 
 def flags(msg):
+    if hasattr(msg, 'flag_names'):
+        return len(msg.flag_names) > 0
     if MessageFlag.objects.filter(message__pk=msg.pk).count() > 0:
         return True
     else:
         return False
 
-register = template.Library()
+
+def flag_names(msg):
+    if not hasattr(msg, 'flag_names'):
+        attach_flag_names([msg])
+    return [name for name in msg.flag_names if name]
+
+
+def message_responses(msg):
+    if not hasattr(msg, 'prefetched_responses'):
+        attach_responses([msg])
+    return msg.prefetched_responses
+
+
+def handler_has_errors(msg):
+    if not hasattr(msg, 'handler_has_errors'):
+        attach_handler_errors([msg])
+    return msg.handler_has_errors
+
+
+def status_display(status):
+    return STATUS_NAMES.get(status, status)
+
+
+def direction_display(direction):
+    return DIRECTION_NAMES.get(direction, direction)
+
+
+class MessageFlagsNode(template.Node):
+    def __init__(self, message, messages):
+        self.message = template.Variable(message)
+        self.messages = template.Variable(messages)
+
+    def render(self, context):
+        try:
+            message = self.message.resolve(context)
+        except template.VariableDoesNotExist:
+            return ''
+        if not hasattr(message, 'flag_names'):
+            try:
+                messages = list(self.messages.resolve(context))
+            except template.VariableDoesNotExist:
+                messages = []
+            # the first row of a page loads the flags of every row on it
+            attach_flag_names([message] + [m for m in messages if m is not message])
+        return ''
+
+
+def load_message_flags(parser, token):
+    """
+    {% load_message_flags object in object_list %}
+
+    Looks up the flags of every message in ``object_list`` the first time
+    it is used on a page; later rows find their flags already loaded.
+    """
+    bits = token.split_contents()
+    if len(bits) != 4 or bits[2] != 'in':
+        raise template.TemplateSyntaxError("%r expects 'message in message_list'" % bits[0])
+    return MessageFlagsNode(bits[1], bits[3])
+
 register.filter('flags', flags)
+register.filter('flag_names', flag_names)
+register.filter('message_responses', message_responses)
+register.filter('handler_has_errors', handler_has_errors)
+register.filter('status_display', status_display)
+register.filter('direction_display', direction_display)
+register.tag('load_message_flags', load_message_flags)
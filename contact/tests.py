@@ -0,0 +1,238 @@
+import datetime
+from django.contrib.auth.models import Group, User
+from django.template.loader import render_to_string
+from django.test import TestCase
+from django.test.client import RequestFactory
+from rapidsms.models import Backend, Connection, Contact
+from rapidsms_httprouter.models import Message
+from contact.bulk import add_to_groups, remove_from_groups, flag_messages, unflag_messages
+from contact.forms import FlaggedForm
+from contact.models import Flag, MessageFlag, FlaggedMessage, OutboundMessage
+from contact.outbound import TokenBucket, Drainer, FakeSender, MAX_ATTEMPTS
+from contact.utils import get_messages
+
+
+class MessageRowQueriesTest(TestCase):
+    """
+    Rendering a page of the message log costs the same number of queries
+    however many rows the page has.
+    """
+
+    def setUp(self):
+        backend = Backend.objects.create(name='test')
+        flag = Flag.objects.create(name='urgent')
+        start = datetime.datetime(2011, 1, 1)
+        for i in range(30):
+            contact = Contact.objects.create(name='reporter %d' % i)
+            connection = Connection.objects.create(identity='25677200%04d' % i, backend=backend, contact=contact)
+            message = Message.objects.create(connection=connection, text='message %d' % i, direction='I',
+                                             status='H', application='poll' if i % 3 else None)
+            Message.objects.filter(pk=message.pk).update(date=start + datetime.timedelta(minutes=i))
+            if i % 2:
+                Message.objects.create(connection=connection, text='reply %d' % i, direction='O',
+                                       status='S', in_response_to=message)
+            if i % 4 == 0:
+                MessageFlag.objects.create(message=message, flag=flag)
+        user = User.objects.create_user('admin', 'admin@example.com', 'admin')
+        user.is_staff = True
+        user.save()
+        self.request = RequestFactory().get('/contact/messagelog/')
+        self.request.user = user
+
+    def render_page(self, size):
+        page = list(get_messages(request=self.request).order_by('-date')[:size])
+        self.assertEqual(len(page), size)
+        for message in page:
+            render_to_string('contact/partials/message_row.html', {
+                'object': message,
+                'object_list': page,
+                'selectable': True,
+            })
+
+    def test_queries_per_page_are_constant(self):
+        self.render_page(1)
+        # the page itself, responses, poll errors and flags
+        for size in (1, 10, 25):
+            self.assertNumQueries(4, self.render_page, size)
+
+
+class GroupMembershipTest(TestCase):
+
+    def setUp(self):
+        for i in range(4):
+            Contact.objects.create(name='reporter %d' % i)
+        self.teachers = Group.objects.create(name='teachers')
+        self.nurses = Group.objects.create(name='nurses')
+        for contact in Contact.objects.filter(name__in=['reporter 0', 'reporter 1']):
+            contact.groups.add(self.teachers)
+
+    def members(self, group):
+        return sorted(Contact.objects.filter(groups=group).values_list('name', flat=True))
+
+    def test_add_skips_existing_memberships(self):
+        self.assertEqual(add_to_groups(Contact.objects.all(), [self.teachers, self.nurses.pk]), 6)
+        self.assertEqual(self.members(self.teachers), ['reporter %d' % i for i in range(4)])
+        self.assertEqual(self.members(self.nurses), ['reporter %d' % i for i in range(4)])
+        self.assertEqual(add_to_groups(Contact.objects.all(), [self.teachers, self.nurses]), 0)
+        self.assertEqual(Contact.groups.through.objects.count(), 8)
+
+    def test_remove_counts_the_memberships_removed(self):
+        contacts = Contact.objects.filter(name__in=['reporter 1', 'reporter 2'])
+        self.assertEqual(remove_from_groups(contacts, [self.teachers, self.nurses]), 1)
+        self.assertEqual(self.members(self.teachers), ['reporter 0'])
+        self.assertEqual(remove_from_groups(contacts, [self.teachers, self.nurses]), 0)
+
+    def test_empty_selections_change_nothing(self):
+        self.assertEqual(add_to_groups(Contact.objects.none(), [self.nurses]), 0)
+        self.assertEqual(add_to_groups(Contact.objects.all(), []), 0)
+        self.assertEqual(remove_from_groups(Contact.objects.none(), [self.teachers]), 0)
+        self.assertEqual(self.members(self.teachers), ['reporter 0', 'reporter 1'])
+
+
+class FlagMessagesTest(TestCase):
+
+    def setUp(self):
+        backend = Backend.objects.create(name='test')
+        connection = Connection.objects.create(identity='256772000001', backend=backend)
+        self.messages = [Message.objects.create(connection=connection, text='message %d' % i, direction='I',
+                                                status='H') for i in range(4)]
+        self.urgent = Flag.objects.create(name='urgent')
+        self.spam = Flag.objects.create(name='spam')
+        MessageFlag.objects.create(message=self.messages[0], flag=self.urgent)
+        MessageFlag.objects.create(message=self.messages[1], flag=None)
+
+    def incoming(self):
+        return Message.objects.filter(direction='I')
+
+    def counts(self):
+        """ the flag count of each message, as kept in FlaggedMessage and as counted """
+        kept = dict(FlaggedMessage.objects.values_list('message', 'flag_count'))
+        kept = [kept.get(message.pk, 0) for message in self.messages]
+        counted = [MessageFlag.objects.filter(message=message).count() for message in self.messages]
+        self.assertEqual(kept, counted)
+        return counted
+
+    def flagged(self, value):
+        form = FlaggedForm({'flagged': value}, request=None)
+        self.assertTrue(form.is_valid())
+        return form.filter(None, self.incoming())
+
+    def test_flagging_skips_messages_already_flagged(self):
+        self.assertEqual(flag_messages(self.incoming(), self.urgent), 3)
+        self.assertEqual(self.counts(), [1, 2, 1, 1])
+        self.assertEqual(flag_messages(self.incoming(), self.urgent), 0)
+        self.assertEqual(flag_messages(self.incoming(), self.spam.pk), 4)
+        self.assertEqual(self.counts(), [2, 3, 2, 2])
+
+    def test_plain_flags_are_not_duplicated(self):
+        self.assertEqual(flag_messages(self.incoming()), 3)
+        self.assertEqual(flag_messages(self.incoming()), 0)
+        self.assertEqual(MessageFlag.objects.filter(flag=None).count(), 4)
+        self.assertEqual(self.counts(), [2, 1, 1, 1])
+
+    def test_unflagging_counts_the_flags_removed(self):
+        flag_messages(self.incoming(), self.spam)
+        self.assertEqual(unflag_messages(self.incoming(), self.spam), 4)
+        self.assertEqual(self.counts(), [1, 1, 0, 0])
+        self.assertEqual(unflag_messages(self.incoming(), self.spam), 0)
+        self.assertEqual(unflag_messages(self.incoming()), 1)
+        self.assertEqual(self.counts(), [1, 0, 0, 0])
+        self.assertEqual(FlaggedMessage.objects.count(), 1)
+
+    def test_unflagging_a_selection_filtered_on_flags(self):
+        flag_messages(self.incoming().filter(pk=self.messages[0].pk), self.spam)
+        self.assertEqual(self.counts(), [2, 1, 0, 0])
+        # removing the flags takes the messages out of the filtered selection
+        self.assertEqual(unflag_messages(self.flagged('1'), all_flags=True), 3)
+        self.assertEqual(self.counts(), [0, 0, 0, 0])
+        self.assertEqual(FlaggedMessage.objects.count(), 0)
+
+    def test_flagging_a_selection_filtered_on_flags(self):
+        self.assertEqual(flag_messages(self.flagged('0'), self.urgent), 2)
+        self.assertEqual(self.counts(), [1, 1, 1, 1])
+        self.assertEqual(self.flagged('0').count(), 0)
+        self.assertEqual(flag_messages(self.flagged('1'), self.urgent), 1)
+        self.assertEqual(self.counts(), [1, 2, 1, 1])
+
+
+class Clock(object):
+    """ a clock the tests move by hand """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(TestCase):
+
+    def test_bursts_then_refills_at_its_rate(self):
+        clock = Clock()
+        bucket = TokenBucket(2, 4, clock)
+        self.assertEqual(bucket.available(), 4)
+        bucket.take(4)
+        self.assertEqual(bucket.available(), 0)
+        self.assertAlmostEqual(bucket.wait(), 0.5)
+        clock.now += 1
+        self.assertEqual(bucket.available(), 2)
+        clock.now += 60
+        self.assertEqual(bucket.available(), 4)
+
+
+class DrainerTest(TestCase):
+
+    def setUp(self):
+        del FakeSender.sent[:]
+        self.clock = Clock()
+        backend = Backend.objects.create(name='test')
+        due = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        for i in range(5):
+            connection = Connection.objects.create(identity='25677100%04d' % i, backend=backend)
+            OutboundMessage.objects.create(connection=connection, backend=backend, text='hello',
+                                           not_before=due)
+
+    def drainer(self, failure_rate=0.0):
+        return Drainer(FakeSender(failure_rate), rates={'default': (1, 2)}, clock=self.clock)
+
+    def test_releases_no_faster_than_the_rate(self):
+        drainer = self.drainer()
+        handled, wait = drainer.drain()
+        self.assertEqual(handled, 2)
+        self.assertAlmostEqual(wait, 1.0)
+        self.assertEqual(drainer.drain(), (0, 1.0))
+        self.clock.now += 1
+        self.assertEqual(drainer.drain()[0], 1)
+        self.assertEqual(len(FakeSender.sent), 3)
+        self.assertEqual(OutboundMessage.objects.filter(status=OutboundMessage.queued).count(), 2)
+
+    def test_marks_released_messages(self):
+        drainer = self.drainer()
+        for i in range(3):
+            drainer.drain()
+            self.clock.now += 2
+        released = OutboundMessage.objects.filter(status=OutboundMessage.released)
+        self.assertEqual(released.count(), 5)
+        self.assertEqual(released.filter(released_at=None).count(), 0)
+        self.assertEqual(sorted([pk for backend, pk, at in FakeSender.sent]),
+                         sorted(OutboundMessage.objects.values_list('pk', flat=True)))
+        self.assertEqual(drainer.drain(), (0, None))
+
+    def test_retries_failures_then_gives_up(self):
+        OutboundMessage.objects.exclude(pk=OutboundMessage.objects.order_by('pk')[0].pk).delete()
+        drainer = self.drainer(failure_rate=1.0)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            message = OutboundMessage.objects.get()
+            self.assertEqual(message.status, OutboundMessage.queued)
+            self.assertEqual(drainer.drain()[0], 1)
+            message = OutboundMessage.objects.get()
+            self.assertEqual(message.attempts, attempt)
+            self.assertEqual(message.last_error, 'fake failure')
+            # held back until the retry delay has passed
+            self.assertTrue(message.not_before > datetime.datetime.now())
+            self.assertEqual(drainer.drain(), (0, None))
+            OutboundMessage.objects.update(not_before=datetime.datetime.now() - datetime.timedelta(seconds=1))
+            self.clock.now += 2
+        self.assertEqual(OutboundMessage.objects.get().status, OutboundMessage.failed)
+        self.assertEqual(drainer.drain(), (0, None))
+        self.assertEqual(FakeSender.sent, [])
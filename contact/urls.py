@@ -1,19 +1,21 @@
 from django.conf.urls.defaults import *
-from .views import add_contact, new_contact, view_message_history
+from .views import add_contact, new_contact, view_message_history, message_history_page, message_log, export_message_log, mass_text_progress, outbound_metrics, import_contacts
 from .forms import FreeSearchForm, FilterGroupsForm, MassTextForm
 from rapidsms.models import Contact
 from generic.views import generic
-from .utils import get_messages, get_mass_messages
+from .utils import get_messages, get_mass_messages, get_contacts
+from .querysets import MassMessageSorter
 from django.contrib.auth.decorators import login_required
 from rapidsms_httprouter.models import Message
-from generic.sorters import SimpleSorter, TupleSorter
+from generic.sorters import SimpleSorter
 from .forms import FreeSearchTextForm, DistictFilterMessageForm, HandledByForm, ReplyTextForm, FlaggedForm, FlagMessageForm
 from contact.models import MassText
 
 urlpatterns = patterns('',
-   url(r'^contact/index/$', generic, {'model':Contact, 'filter_forms':[FreeSearchForm, FilterGroupsForm], 'action_forms':[MassTextForm], 'objects_per_page':25}),
+   url(r'^contact/index/$', generic, {'model':Contact, 'queryset':get_contacts, 'filter_forms':[FreeSearchForm, FilterGroupsForm], 'action_forms':[MassTextForm], 'objects_per_page':25}),
    url(r'^contact/add', add_contact),
    url(r'^contact/new', new_contact),
+   url(r'^contact/import/$', import_contacts, name="contact-import"),
    url(r'^contact/messagelog/$', login_required(generic), {
       'model':Message,
       'queryset':get_messages,
@@ -31,21 +33,26 @@ urlpatterns = patterns('',
       'sort_column':'date',
       'sort_ascending':False,
     }, name="contact-messagelog"),
+   url(r'^contact/messagelog/seek/$', message_log, name="contact-messagelog-seek"),
+   url(r'^contact/messagelog/export/$', export_message_log, name="contact-messagelog-export"),
    url(r'^contact/massmessages/$', login_required(generic), {
       'model':MassText,
       'queryset':get_mass_messages,
       'objects_per_page':10,
       'partial_row':'contact/partials/mass_message_row.html',
       'base_template':'contact/mass_messages_base.html',
-      'columns':[('Message', True, 'text', TupleSorter(0)),
-                 ('Time', True, 'date', TupleSorter(1),),
-                 ('User', True, 'user', TupleSorter(2),),
-                 ('Recipients', True, 'response', TupleSorter(3),),
-                 ('Type', True, 'type', TupleSorter(4),),
+      'columns':[('Message', True, 'text', MassMessageSorter()),
+                 ('Time', True, 'date', MassMessageSorter(),),
+                 ('User', True, 'user', MassMessageSorter(),),
+                 ('Recipients', True, 'recipients', MassMessageSorter(),),
+                 ('Type', True, 'type', MassMessageSorter(),),
                  ],
       'sort_column':'date',
       'sort_ascending':False,
       'selectable':False,
     }),
+    url(r"^contact/outbound/metrics/$", outbound_metrics, name="outbound_metrics"),
+    url(r"^contact/massmessages/(\d+)/progress/$", mass_text_progress, name="mass_text_progress"),
     url(r"^contact/(\d+)/message_history/$", view_message_history, name="message_history"),
+    url(r"^contact/(\d+)/message_history/older/$", message_history_page, name="message_history_page"),
 )
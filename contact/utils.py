@@ -1,15 +1,62 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed
+from rapidsms.models import Contact, Connection
 from rapidsms_httprouter.models import Message
-from contact.models import MassText
-from poll.models import Poll
+from contact.cache import get_generation, bump_generation
+from contact.querysets import message_row_queryset, CountCacheQuerySet, MassMessageList
+
+VISIBLE_GROUPS_GENERATION = 'contact-visible-groups-generation'
+VISIBLE_GROUPS_TIMEOUT = 300
+
+def get_visible_group_ids(request):
+    """
+    Returns the pks of the groups whose contacts' messages a non-staff user
+    may see.  They are looked up once per request and cached for a few
+    minutes, or until any user's group membership changes.
+    """
+    if not hasattr(request, '_contact_visible_group_ids'):
+        key = 'contact-visible-groups-%s-%s' % (get_generation(VISIBLE_GROUPS_GENERATION), request.user.pk)
+        group_ids = cache.get(key)
+        if group_ids is None:
+            group_ids = list(request.user.groups.values_list('pk', flat=True))
+            cache.set(key, group_ids, VISIBLE_GROUPS_TIMEOUT)
+        request._contact_visible_group_ids = group_ids
+    return request._contact_visible_group_ids
+
+def user_groups_changed(sender, **kwargs):
+    if kwargs['action'] in ('post_add', 'post_remove', 'post_clear'):
+        bump_generation(VISIBLE_GROUPS_GENERATION)
+
+m2m_changed.connect(user_groups_changed, sender=User.groups.through)
 
 def get_messages(**kwargs):
     request = kwargs.pop('request')
     if request.user.is_authenticated():
-        if request.user.is_staff:
-            return Message.objects.filter(direction='I').select_related()
-        else:
-            return Message.objects.filter(direction='I', connection__contact__groups__in=request.user.groups.all()).select_related().distinct()
+        messages = Message.objects.filter(direction='I')
+        if not request.user.is_staff:
+            # a semi-join on the visible connections: no duplicate rows, so no DISTINCT
+            visible = Connection.objects.filter(contact__groups__in=get_visible_group_ids(request))
+            messages = messages.filter(connection__in=visible.values('pk'))
+        return message_row_queryset(messages)
+
+def get_contacts(**kwargs):
+    return Contact.objects.all()._clone(klass=CountCacheQuerySet)
+
+def apply_filter_forms(request, queryset, filter_forms, data):
+    """
+    Binds every filter form in ``filter_forms`` to ``data`` and narrows
+    ``queryset`` with each one that validates, the way the generic views
+    apply their filter_forms.  Returns the bound forms and the queryset.
+    """
+    forms = []
+    for form_class in filter_forms:
+        form = form_class(data, request=request)
+        if form.is_valid():
+            queryset = form.filter(request, queryset)
+        forms.append(form)
+    return forms, queryset
 
 def get_mass_messages(**kwargs):
-    return [(p.question, p.start_date, p.user.username, p.contacts.count(), 'Poll Message') for p in Poll.objects.exclude(start_date=None)] + [(m.text, m.date, m.user.username, m.contacts.count(), 'Mass Text') for m in MassText.objects.all()]
+    return MassMessageList()
 
@@ -1,14 +1,23 @@
 from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils import simplejson
 from django.shortcuts import  render_to_response, get_object_or_404, redirect
 from rapidsms.models import Contact, Connection
-from contact.forms import NewContactForm, FreeSearchForm
+from contact.forms import NewContactForm, FreeSearchForm, ContactImportForm
 from django.core.paginator import Paginator, InvalidPage
-from django.http import Http404, HttpResponseRedirect
-from rapidsms_httprouter.models import STATUS_CHOICES, DIRECTION_CHOICES, Message
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from rapidsms_httprouter.models import Message
 from rapidsms.messages.outgoing import OutgoingMessage
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, permission_required
 from . import forms
-from .forms import ReplyForm
+from .forms import ReplyForm, FreeSearchTextForm, DistictFilterMessageForm, HandledByForm, FlaggedForm
+from .models import ConversationSummary, MassText
+from .paginator import KeysetPaginator, InvalidCursor
+from .querysets import PrefetchQuerySet, attach_responses
+from .utils import get_messages, apply_filter_forms
+from .export import message_rows, FORMATS
+from .outbound import metrics
+from .importer import ContactImporter, ContactImportError, read_rows
 from rapidsms_httprouter.router import get_router
 from django.forms.util import ErrorList
 
@@ -26,6 +35,51 @@ def new_contact(request):
     new_contact_form = NewContactForm()
     return render_to_response('contact/partials/new_contact.html', {'new_contact_form':new_contact_form})
 
+@permission_required('rapidsms.add_contact')
+def import_contacts(request):
+    """
+        Imports an uploaded csv or xlsx contact list, creating a contact
+        and connection for each new number, and reports what was done.
+    """
+    importer = None
+    if request.method == "POST":
+        form = ContactImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            backend = form.cleaned_data['backend']
+            importer = ContactImporter(backend=backend.name if backend else None,
+                                       dry_run=form.cleaned_data['dry_run'])
+            try:
+                importer.run(read_rows(upload, upload.name))
+            except ContactImportError, e:
+                form._errors['file'] = ErrorList([unicode(e)])
+                importer = None
+    else:
+        form = ContactImportForm()
+    return render_to_response("contact/import_contacts.html", {
+        'form': form,
+        'importer': importer,
+    }, context_instance=RequestContext(request))
+
+MESSAGE_HISTORY_PAGE_SIZE = 50
+
+def get_history_page(connection, after=None):
+    """
+        Returns a page of the messages exchanged with a connection's contact
+        (or with the connection itself when it has no contact), newest first,
+        starting after the ``after`` cursor, with their responses prefetched.
+    """
+    if connection.contact_id:
+        messages = Message.objects.filter(connection__contact=connection.contact_id)
+    else:
+        messages = Message.objects.filter(connection=connection)
+    messages = messages._clone(klass=PrefetchQuerySet).prefetch_bundle(attach_responses)
+    paginator = KeysetPaginator(messages, MESSAGE_HISTORY_PAGE_SIZE, 'date', False)
+    try:
+        return paginator.page(after=after)
+    except InvalidCursor:
+        raise Http404
+
 @login_required
 def view_message_history(request, connection_id):
     """
@@ -33,22 +87,14 @@ def view_message_history(request, connection_id):
         RapidSMS and a User 
         
     """
-    direction_choices = DIRECTION_CHOICES
-    status_choices = STATUS_CHOICES
     reply_form = ReplyForm()
     connection = get_object_or_404(Connection, pk=connection_id)
 
-    if connection.contact:
-        messages = Message.objects.filter(connection__contact=connection.contact)
+    if connection.contact_id:
+        summary = ConversationSummary.for_contact(connection.contact_id)
     else:
-        messages = Message.objects.filter(connection=connection)
-    messages = messages.order_by('-date')
-
-    total_incoming = messages.filter(direction="I").count()
-    total_outgoing = messages.filter(direction="O").count()
-    latest_message = None
-    if total_incoming:
-        latest_message = messages.filter(direction="I").latest('date')
+        summary = ConversationSummary.combine(
+            ConversationSummary.objects.filter(connection=connection).select_related('last_incoming'))
 
     if request.method == 'POST':
         reply_form = ReplyForm(request.POST)
@@ -64,13 +110,149 @@ def view_message_history(request, connection_id):
                 reply_form.errors.setdefault('short_description', ErrorList())
                 reply_form.errors['recipient'].append("This number isn't in the system")
 
+    page = get_history_page(connection)
     return render_to_response("contact/message_history.html", {
-        "messages": messages,
-        "stats_latest_message": latest_message,
-        "stats_total_incoming": total_incoming,
-        "stats_total_outgoing": total_outgoing,
+        "messages": page.object_list,
+        "next_cursor": page.next_cursor(),
+        "stats_latest_message": summary['last_incoming'],
+        "stats_total_incoming": summary['incoming'],
+        "stats_total_outgoing": summary['outgoing'],
         "connection": connection,
-        "direction_choices": direction_choices,
-        "status_choices": status_choices,
         "replyForm": reply_form
     }, context_instance=RequestContext(request))
+
+def _message_json(message):
+    return {
+        'id': message.pk,
+        'text': message.text,
+        'date': message.date.isoformat() if message.date else None,
+        'direction': message.direction,
+        'status': message.status,
+        'in_response_to': message.in_response_to_id,
+    }
+
+@login_required
+def message_history_page(request, connection_id):
+    """
+        JSON for the page of a connection's message history that follows
+        the ?after= cursor: the messages with their responses, the same
+        page rendered as accordion rows, and the cursor of the next page
+        (null on the last one).
+    """
+    connection = get_object_or_404(Connection, pk=connection_id)
+    page = get_history_page(connection, request.GET.get('after'))
+    messages = []
+    for message in page.object_list:
+        data = _message_json(message)
+        data['responses'] = [_message_json(r) for r in message.prefetched_responses]
+        messages.append(data)
+    html = render_to_string("contact/partials/message_history_rows.html", {
+        "messages": page.object_list,
+        "connection": connection,
+    }, context_instance=RequestContext(request))
+    return HttpResponse(simplejson.dumps({
+        'messages': messages,
+        'html': html,
+        'next': page.next_cursor(),
+    }), mimetype='application/json')
+
+MESSAGE_LOG_FILTER_FORMS = [FreeSearchTextForm, DistictFilterMessageForm, HandledByForm, FlaggedForm]
+MESSAGE_LOG_COLUMNS = [('Text', 'text'),
+                       ('Contact Information', 'connection__contact__name'),
+                       ('Date', 'date'),
+                       ('Type', 'application')]
+# the columns the message log can be sorted by: the ones with a (column, id)
+# index on the message table (migrations 0004 and 0014) to seek through
+MESSAGE_LOG_SORT_COLUMNS = ('date', 'application')
+
+@login_required
+def message_log(request):
+    """
+        The message log with keyset pagination: the same filters as
+        contact-messagelog, but pages are addressed by a cursor on
+        (sort column, pk), so a deep page costs as much as the first and
+        no total count is needed.
+    """
+    sort_column = request.GET.get('sort', 'date')
+    if sort_column not in MESSAGE_LOG_SORT_COLUMNS:
+        sort_column = 'date'
+    ascending = request.GET.get('order') == 'asc'
+
+    filter_forms, messages = apply_filter_forms(request, get_messages(request=request),
+                                                MESSAGE_LOG_FILTER_FORMS, request.GET)
+    paginator = KeysetPaginator(messages, 25, sort_column, ascending)
+    try:
+        page = paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
+    except InvalidCursor:
+        raise Http404
+
+    query = request.GET.copy()
+    for key in ('after', 'before'):
+        if key in query:
+            del query[key]
+    filters = query.copy()
+    for key in ('sort', 'order'):
+        if key in filters:
+            del filters[key]
+
+    return render_to_response("contact/message_log.html", {
+        "page": page,
+        "object_list": page.object_list,
+        "filter_forms": filter_forms,
+        "columns": MESSAGE_LOG_COLUMNS,
+        "sort_columns": MESSAGE_LOG_SORT_COLUMNS,
+        "sort_column": sort_column,
+        "ascending": ascending,
+        "query": query.urlencode(),
+        "filters": filters.urlencode(),
+    }, context_instance=RequestContext(request))
+
+
+@login_required
+def export_message_log(request):
+    """
+        Streams the message log, narrowed by the same filters and user
+        scoping as contact-messagelog, as CSV (the default) or NDJSON
+        (?format=ndjson).  ?details=1 adds contact name, district and flag
+        names.  Rows are read and written a chunk at a time, so memory use
+        doesn't grow with the size of the export.
+    """
+    if request.GET.get('format', 'csv') not in FORMATS:
+        raise Http404
+    lines, mimetype, extension = FORMATS[request.GET.get('format', 'csv')]
+    details = request.GET.get('details') == '1'
+
+    filter_forms, messages = apply_filter_forms(request, get_messages(request=request),
+                                                MESSAGE_LOG_FILTER_FORMS, request.GET)
+    response = HttpResponse(lines(message_rows(messages, details), details), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=messages.%s' % extension
+    return response
+
+
+@login_required
+def mass_text_progress(request, masstext_id):
+    """
+        JSON progress of a queued mass text, polled by the mass messages
+        page while it is being sent.
+    """
+    masstext = get_object_or_404(MassText, pk=masstext_id)
+    return HttpResponse(simplejson.dumps({
+        'status': masstext.status,
+        'status_display': masstext.get_status_display(),
+        'in_progress': masstext.in_progress(),
+        'recipients': masstext.recipient_count,
+        'sent': masstext.sent_count,
+        'failed': masstext.failed_count,
+        'error': masstext.last_error,
+        'started': masstext.started.isoformat() if masstext.started else None,
+        'finished': masstext.finished.isoformat() if masstext.finished else None,
+    }), mimetype='application/json')
+
+
+@login_required
+def outbound_metrics(request):
+    """
+        JSON queue depth and release rate of the outbound scheduler, per
+        backend.
+    """
+    return HttpResponse(simplejson.dumps(metrics()), mimetype='application/json')